@@ -0,0 +1,102 @@
+import asyncio
+import inspect
+
+from audio_to_midi import api
+
+
+def _start(source, samplerate, options):
+    process = api.create_converter(source, samplerate, **options)
+    writer = process._create_writer()
+    writer.__enter__()
+    return process, writer, process._read_frames()
+
+
+def _step(process, writer, batches):
+    """
+    Analyses the next batch of time windows and returns their number,
+        or finishes the writer and returns 0 after the last batch.
+    """
+
+    frames = next(batches, None)
+    if frames is None:
+        writer.__exit__(None, None, None)
+        return 0
+
+    process._write_velocities(writer, process._frames_to_velocities(frames))
+    return len(frames)
+
+
+def _held(writer):
+    """
+    Returns the position of the first event whose velocity may still
+        change, the note on of the earliest condensed note still
+        sounding, or the number of events if there is none.
+    """
+
+    compiler = writer.compiler
+    if not compiler or not compiler.condense or not compiler.active.any():
+        return writer.size
+    return int(compiler.pos[compiler.active].min())
+
+
+async def convert_events(
+    source, samplerate=None, limit=None, executor=None, progress=None, **options
+):
+    """
+    source is a (frames,) or (frames, channels) array of samples, which
+        needs a samplerate, a file-like object or a path.
+    limit is an asyncio.Semaphore shared by the conversions which may
+        run at the same time.
+    executor is the thread pool which decodes and analyses the input,
+        by default the event loop's.
+    progress is called with the number of time windows converted and
+        their total after every batch, and awaited if it returns an
+        awaitable.
+    options are the keyword arguments passed to the Converter.
+
+    An async generator which yields the events.EVENT_DTYPE array of
+        each batch of batch_size time windows, analysed in executor so
+        the event loop isn't blocked. The notes still sounding at the
+        end are ended by the last array. With condense, the events from
+        the note on of a note which is still sounding are held back
+        until the note ends, so the velocities are the same as
+        api.convert_to_notes() returns whatever the batch_size.
+
+    Cancelling the consuming task stops the conversion between batches.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    # A semaphore of its own doesn't limit anything, and unlike
+    # contextlib.nullcontext() it can be used with async with before
+    # Python 3.10.
+    async with limit or asyncio.Semaphore():
+        # The steps are shielded so cancelling the task doesn't cancel a
+        # future whose work is still running in the executor.
+        step = loop.run_in_executor(executor, _start, source, samplerate, options)
+        try:
+            process, writer, batches = await asyncio.shield(step)
+            position = 0
+            current = 0
+            while True:
+                step = loop.run_in_executor(executor, _step, process, writer, batches)
+                count = await asyncio.shield(step)
+
+                held = _held(writer)
+                events = writer.events[position:held].copy()
+                position = held
+                if len(events):
+                    yield events
+
+                if not count:
+                    return
+                current += count
+                if progress:
+                    result = progress(current, process.windows)
+                    if inspect.isawaitable(result):
+                        await result
+        finally:
+            # A batch which is being analysed when the conversion is
+            # cancelled still holds its slot until it's done.
+            if not step.done():
+                await asyncio.wait([step])
@@ -0,0 +1,72 @@
+import numpy
+
+from audio_to_midi import converter, events
+
+# The conversion options used when they aren't given, the same as the
+# command line defaults.
+DEFAULTS = {
+    "time_window": 5.0,
+    "activation_level": 0.0,
+    "condense": False,
+    "condense_max": False,
+    "max_note_length": 0,
+    "note_count": 0,
+    "transpose": 0,
+    "pitch_set": [],
+    "bpm": 60,
+    "batch_size": converter.DEFAULT_BATCH_SIZE,
+}
+
+
+def create_converter(source, samplerate=None, **options):
+    """
+    source is a (frames,) or (frames, channels) array of samples, which
+        needs a samplerate, a file-like object or a path.
+    options are the keyword arguments passed to the Converter.
+
+    Returns a Converter for source which keeps its events in memory.
+    """
+
+    options = dict(DEFAULTS, **options)
+    options["in_memory"] = True
+    if isinstance(source, numpy.ndarray):
+        return converter.Converter(samples=source, samplerate=samplerate, **options)
+    return converter.Converter(infile=source, **options)
+
+
+def _convert(source, samplerate=None, **options):
+    """
+    Converts source, as for create_converter(), without writing a file
+        and returns the MemoryMidiWriter holding the events.
+    """
+
+    return create_converter(source, samplerate, **options).convert()
+
+
+def convert_to_notes(source, samplerate=None, **options):
+    """
+    Converts source, as for _convert(), and returns its notes as an
+        events.NOTE_DTYPE array of tick, channel, pitch, velocity and
+        duration in ticks, ordered by their start.
+    """
+
+    writer = _convert(source, samplerate, **options)
+    return events.pair_notes(writer.events[: writer.size])
+
+
+def iter_notes(source, samplerate=None, **options):
+    """
+    Like convert_to_notes(), returning an iterator of
+        (tick, channel, pitch, velocity, duration) tuples.
+    """
+
+    return iter(convert_to_notes(source, samplerate, **options).tolist())
+
+
+def convert_to_bytes(source, samplerate=None, **options):
+    """
+    Converts source, as for _convert(), and returns the standard MIDI
+        file as bytes.
+    """
+
+    return _convert(source, samplerate, **options).to_bytes()
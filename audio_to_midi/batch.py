@@ -0,0 +1,228 @@
+import glob
+import hashlib
+import logging
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import soundfile
+
+from audio_to_midi import converter
+
+
+class Result:
+    __slots__ = ["infile", "outfile", "duration", "skipped", "error"]
+
+    def __init__(self, infile, outfile, duration=0.0, skipped=False, error=None):
+        self.infile = infile
+        self.outfile = outfile
+        self.duration = duration
+        self.skipped = skipped
+        self.error = error
+
+
+def _is_audio_file(path):
+    extension = os.path.splitext(path)[1][1:].upper()
+    return extension in soundfile.available_formats()
+
+
+def _pattern_root(pattern):
+    # The directory above the first component with glob characters.
+    parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts)
+
+
+def expand_inputs(patterns, manifest=None):
+    """
+    patterns is a list of files, directories or glob patterns.
+    manifest is an optional file listing one input per line.
+
+    Expands the inputs into an ordered list of unique (infile, root)
+        pairs, root being the directory which infile's output path
+        in an output directory is relative to. Directories are searched
+        recursively for files in a format supported by soundfile. A
+        path which exists is never taken as a pattern, and a pattern
+        which matches no files is kept as it is so converting it fails.
+    """
+
+    inputs = [(pattern, None) for pattern in patterns]
+    if manifest:
+        base = os.path.dirname(manifest)
+        with open(manifest, "r") as infile:
+            for line in infile:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    inputs.append((os.path.join(base, line), base))
+
+    paths = {}
+    for pattern, root in inputs:
+        if os.path.isdir(pattern):
+            matches = [
+                path
+                for path in glob.glob(
+                    os.path.join(glob.escape(pattern), "**"), recursive=True
+                )
+                if os.path.isfile(path) and _is_audio_file(path)
+            ]
+            root = pattern
+        elif not os.path.exists(pattern) and glob.has_magic(pattern):
+            matches = glob.glob(pattern, recursive=True) or [pattern]
+            root = _pattern_root(pattern)
+        else:
+            matches = [pattern]
+        for path in sorted(matches):
+            paths.setdefault(path, os.path.dirname(path) if root is None else root)
+
+    return list(paths.items())
+
+
+def output_path(infile, output_dir=None, root=None):
+    """
+    Returns the MIDI file path for infile, either next to the input
+        or inside output_dir, where it keeps its path relative to root.
+    """
+
+    if output_dir:
+        name = os.path.relpath(infile, root) if root else os.path.basename(infile)
+        return os.path.join(output_dir, "{}.mid".format(name))
+    return "{}.mid".format(infile)
+
+
+def _fingerprint(infile, options):
+    # The spectral cache doesn't change the output.
+    options = {name: value for name, value in options.items() if name != "cache"}
+    digest = hashlib.sha256(repr(sorted(options.items())).encode())
+    with open(infile, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_up_to_date(infile, outfile, skip, fingerprint):
+    if not os.path.exists(outfile):
+        return False
+    if skip == "mtime":
+        return os.path.getmtime(outfile) >= os.path.getmtime(infile)
+    try:
+        with open(outfile + ".sha256", "r") as stream:
+            return stream.read().strip() == fingerprint
+    except OSError:
+        return False
+
+
+def convert_file(infile, outfile, options, skip=None):
+    """
+    Converts a single file with the given Converter options, returning
+        a Result rather than raising so one bad input doesn't stop a
+        batch.
+    """
+
+    try:
+        if not os.path.isfile(infile):
+            raise RuntimeError(
+                "{}: {}".format(
+                    "No files match" if glob.has_magic(infile) else "No such file",
+                    infile,
+                )
+            )
+
+        fingerprint = _fingerprint(infile, options) if skip == "hash" else None
+        if skip and _is_up_to_date(infile, outfile, skip, fingerprint):
+            return Result(infile, outfile, skipped=True)
+
+        process = converter.Converter(infile=infile, outfile=outfile, **options)
+        process.convert()
+
+        if fingerprint:
+            with open(outfile + ".sha256", "w") as stream:
+                stream.write(fingerprint + "\n")
+
+        return Result(infile, outfile, duration=process.info.duration)
+    except Exception as e:
+        return Result(infile, outfile, error="{}: {}".format(type(e).__name__, e))
+
+
+def convert_files(infiles, options, output_dir=None, skip=None, jobs=1):
+    """
+    infiles is a list of sound files to convert, or of (infile, root)
+        pairs as returned by expand_inputs.
+    options are the keyword arguments passed to each Converter.
+
+    Converts every file on a single pool of jobs worker processes and
+        logs a throughput summary. Returns the list of Results in the
+        order the inputs were given.
+    """
+
+    infiles = [(item, None) if isinstance(item, str) else item for item in infiles]
+    outfiles = [output_path(infile, output_dir, root) for infile, root in infiles]
+    infiles = [infile for infile, root in infiles]
+
+    # Two inputs writing the same MIDI file would overwrite each other.
+    seen = {}
+    for infile, outfile in zip(infiles, outfiles):
+        key = os.path.abspath(outfile)
+        if key in seen:
+            raise RuntimeError(
+                "{} and {} would both be written to {}".format(
+                    seen[key], infile, outfile
+                )
+            )
+        seen[key] = infile
+
+    if output_dir:
+        for directory in sorted(set(map(os.path.dirname, outfiles))):
+            os.makedirs(directory, exist_ok=True)
+
+    results = [None for _ in infiles]
+    start = time.perf_counter()
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(convert_file, infile, outfile, options, skip): index
+                for index, (infile, outfile) in enumerate(zip(infiles, outfiles))
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = _report(future.result())
+    else:
+        for index, (infile, outfile) in enumerate(zip(infiles, outfiles)):
+            results[index] = _report(convert_file(infile, outfile, options, skip))
+
+    _summarize(results, time.perf_counter() - start)
+    return results
+
+
+def _report(result):
+    if result.error:
+        logging.error("failed: {} ({})".format(result.infile, result.error))
+    elif result.skipped:
+        logging.info("skipped: {}".format(result.infile))
+    else:
+        logging.info("converted: {} -> {}".format(result.infile, result.outfile))
+    return result
+
+
+def _summarize(results, elapsed):
+    converted = [result for result in results if not (result.skipped or result.error)]
+    skipped = sum(1 for result in results if result.skipped)
+    failed = [result for result in results if result.error]
+    audio = sum(result.duration for result in converted)
+    elapsed = max(elapsed, 1e-9)
+
+    logging.info(
+        "{} converted, {} skipped, {} failed in {:.3f} s".format(
+            len(converted), skipped, len(failed), elapsed
+        )
+    )
+    logging.info(
+        "throughput: {:.3f} files/s, {:.3f} audio-seconds/s".format(
+            len(converted) / elapsed, audio / elapsed
+        )
+    )
+    for result in failed:
+        logging.error("failed: {} ({})".format(result.infile, result.error))
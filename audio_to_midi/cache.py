@@ -0,0 +1,113 @@
+import hashlib
+import os
+
+from contextlib import contextmanager
+
+import numpy
+
+# Bumped whenever the layout of the cached spectra changes.
+VERSION = 1
+
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SpectralCache:
+    """
+    An on-disk cache of per bin velocity spectra, stored as .npy files
+        which are memory mapped when they're read.
+
+    Entries are keyed by the audio content and the parameters which
+        determine the spectrum, so conversions which only change the
+        note selection or writer options skip decoding and the fft.
+        The least recently used entries are evicted once the cache
+        grows beyond max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def __repr__(self):
+        return "SpectralCache({!r}, {!r})".format(self.directory, self.max_bytes)
+
+    def key(self, infile, *params):
+        return hashlib.sha256(
+            repr((VERSION, content_hash(infile)) + params).encode()
+        ).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def load(self, key):
+        """
+        Returns the cached spectrum for key as a read only memory map,
+            or None on a miss.
+        """
+
+        path = self._path(key)
+        try:
+            spectrum = numpy.load(path, mmap_mode="r")
+            # The modification time orders entries for eviction.
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return spectrum
+
+    @contextmanager
+    def create(self, key, shape):
+        """
+        Yields a writable uint8 memory map of the given shape, which is
+            added to the cache under key once the block exits without an
+            error. The memory map stays valid after it has been stored.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temp = "{}.{}.tmp".format(path, os.getpid())
+
+        try:
+            spectrum = numpy.lib.format.open_memmap(
+                temp, mode="w+", dtype=numpy.uint8, shape=shape
+            )
+            yield spectrum
+            spectrum.flush()
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in
+            max_bytes.
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            size -= entry_size
@@ -0,0 +1,264 @@
+import hashlib
+import logging
+import os
+import time
+
+import numpy
+
+from audio_to_midi.events import EVENT_DTYPE
+from audio_to_midi.midi_writer import NoteState
+
+# Bumped whenever the layout of the checkpoint files changes.
+VERSION = 2
+
+DEFAULT_INTERVAL = 60.0
+
+# The EventCompiler attributes which carry its state from one batch to
+# the next.
+COMPILER_FIELDS = [
+    "frame",
+    "emitted",
+    "rank",
+    "active",
+    "count",
+    "total",
+    "peak",
+    "pos",
+]
+
+
+def _key(converter):
+    """
+    Returns a hash of the input file and of the options which determine
+        the events of converter, so a checkpoint is only resumed by the
+        conversion which saved it.
+    """
+
+    stat = os.stat(converter.path)
+    params = (
+        VERSION,
+        os.path.abspath(converter.path),
+        stat.st_size,
+        stat.st_mtime_ns,
+        converter.samplerate,
+        converter.block_size,
+        converter.hop_size,
+        converter.window,
+        converter.engine,
+        converter.fft.name,
+        numpy.dtype(converter.dtype).name,
+        converter.activation_level,
+        converter.bin_indices.tolist(),
+        converter.bin_pitches.tolist(),
+        converter.note_count,
+        bool(converter.condense),
+        converter.condense_max,
+        converter.max_note_length,
+        converter.bpm,
+        converter.hop,
+        converter._batched(),
+        converter.mix,
+        converter.select_channels,
+        converter.duplicate_tolerance if converter.dedupe else 0.0,
+    )
+    return hashlib.sha256(repr(params).encode()).hexdigest()
+
+
+def _open_positions(writer):
+    """
+    Returns the positions of the note ons whose condensed velocity can
+        still change, those of the notes which are sounding.
+    """
+
+    if not writer.condense:
+        return numpy.zeros(0, dtype=numpy.int64)
+    if writer.compiler:
+        return writer.compiler.pos[writer.compiler.active]
+    return numpy.array(
+        [
+            state.event_pos
+            for states in writer.note_state
+            for state in states.values()
+            if state.is_active
+        ],
+        dtype=numpy.int64,
+    )
+
+
+def _note_state(writer):
+    # The notes of each channel are kept in the order they were first
+    # seen, which orders the note offs MidiWriter writes.
+    rows = [
+        (
+            channel,
+            pitch,
+            state.is_active,
+            -1 if state.event_pos is None else state.event_pos,
+            state.count,
+            state.total,
+        )
+        for channel, states in enumerate(writer.note_state)
+        for pitch, state in states.items()
+    ]
+    return numpy.array(rows, dtype=numpy.int64).reshape(-1, 6)
+
+
+class Checkpoint:
+    """
+    Periodically saves the progress of a Converter and the state of its
+        MemoryMidiWriter to the sidecar files path and path.events, so an
+        interrupted conversion can be resumed from the last save with
+        the same output as an uninterrupted run.
+
+    The events are written to path.events as they accumulate, so a save
+        only writes the events since the last one and the note ons of
+        the condensed notes which were sounding then, followed by a
+        small state file which atomically replaces the previous one.
+        Saves are at least interval seconds apart.
+    """
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL, resume=False):
+        if interval <= 0:
+            raise RuntimeError("Invalid checkpoint interval: {}".format(interval))
+
+        self.path = path
+        self.events_path = path + ".events"
+        self.interval = interval
+        self.resume = resume
+        self.key = None
+        # The number of events in events_path, and the positions of the
+        # ones among them whose velocities could still change.
+        self.stored = 0
+        self.open = numpy.zeros(0, dtype=numpy.int64)
+        self.last = time.monotonic()
+
+    def __repr__(self):
+        return "Checkpoint({!r}, {!r}, {!r})".format(
+            self.path, self.interval, self.resume
+        )
+
+    def due(self):
+        return time.monotonic() - self.last >= self.interval
+
+    def start(self, converter, writer):
+        """
+        Restores the state of converter and writer from the checkpoint
+            when resuming, and returns the time window to continue from,
+            which is 0 without one.
+        """
+
+        self.key = _key(converter)
+        self.last = time.monotonic()
+        if not self.resume or not os.path.exists(self.path):
+            if self.resume:
+                logging.info("checkpoint: none found, starting from the beginning")
+            return 0
+
+        with numpy.load(self.path) as state:
+            state = dict(state)
+        if int(state["version"]) != VERSION or str(state["key"]) != self.key:
+            raise RuntimeError(
+                "The checkpoint {} was saved for a different input or options.".format(
+                    self.path
+                )
+            )
+
+        size = int(state["size"])
+        with open(self.events_path, "rb") as stream:
+            events = numpy.frombuffer(
+                stream.read(size * EVENT_DTYPE.itemsize), EVENT_DTYPE
+            )
+        if len(events) != size:
+            raise RuntimeError("The checkpoint {} is incomplete.".format(self.path))
+
+        writer.events = numpy.zeros(max(len(writer.events), 2 * size), EVENT_DTYPE)
+        writer.events[:size] = events
+        # A save which was interrupted may have updated these velocities
+        # past the ones of this checkpoint.
+        writer.events["velocity"][state["open"]] = state["velocities"]
+        writer.size = size
+        writer.time = int(state["time"])
+        writer.skip_count = int(state["skip_count"])
+        writer._need_increment = bool(state["need_increment"])
+
+        if "rank" in state:
+            writer.compiler = writer.create_compiler(converter.note_count > 0)
+            for field in COMPILER_FIELDS:
+                value = state[field]
+                setattr(
+                    writer.compiler, field, value.item() if value.ndim == 0 else value
+                )
+        for channel, pitch, active, pos, count, total in state["notes"].tolist():
+            writer.note_state[channel][pitch] = NoteState(
+                bool(active), None if pos < 0 else pos, count, total
+            )
+
+        converter.skipped = int(state["skipped"])
+        converter.copied = int(state["copied"])
+        self.stored = size
+        self.open = state["open"]
+
+        position = int(state["position"])
+        logging.info(
+            "checkpoint: resuming at window {} of {}".format(
+                position, converter.windows
+            )
+        )
+        return position
+
+    def save(self, converter, writer):
+        """
+        Saves the state of converter and writer after the time windows
+            converted so far.
+        """
+
+        events = writer.events
+        size = EVENT_DTYPE.itemsize
+        with open(self.events_path, "r+b" if self.stored else "wb") as stream:
+            # The notes which were sounding at the last save may have been
+            # condensed since.
+            for pos in self.open.tolist():
+                stream.seek(pos * size)
+                stream.write(events[pos : pos + 1].tobytes())
+            stream.seek(self.stored * size)
+            stream.write(events[self.stored : writer.size].tobytes())
+            stream.flush()
+            os.fsync(stream.fileno())
+
+        self.open = _open_positions(writer)
+        state = {
+            "version": VERSION,
+            "key": self.key,
+            "position": converter.position,
+            "skipped": converter.skipped,
+            "copied": converter.copied,
+            "size": writer.size,
+            "time": writer.time,
+            "skip_count": writer.skip_count,
+            "need_increment": writer._need_increment,
+            "open": self.open,
+            "velocities": events["velocity"][self.open],
+            "notes": _note_state(writer),
+        }
+        if writer.compiler:
+            for field in COMPILER_FIELDS:
+                state[field] = getattr(writer.compiler, field)
+
+        temp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(temp, "wb") as stream:
+            numpy.savez(stream, **state)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(temp, self.path)
+
+        self.stored = writer.size
+        self.last = time.monotonic()
+
+    def remove(self):
+        """
+        Removes the checkpoint files once the conversion has finished.
+        """
+
+        for path in [self.path, self.events_path]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -1,13 +1,95 @@
 import logging
+import os
 
-from collections import namedtuple
+from collections import deque, namedtuple
 from functools import lru_cache
 from operator import attrgetter
 
 import numpy
 import soundfile
 
-from audio_to_midi import midi_writer, notes
+from audio_to_midi import fft, filterbank, midi_writer, notes, options, pcm, resample
+
+DEFAULT_BATCH_SIZE = 512
+
+# The number of batches each worker process analyses per task.
+SEGMENT_BATCHES = 4
+
+# The bound on the magnitudes of a window which the energy gate compares
+# with the activation level is raised by this factor, plus the rounding of
+# its sum, so rounding in the fft can't lift a gated window's magnitudes
+# above it.
+GATE_MARGIN = 1.001
+
+# The properties of the input, taken from the open sound file, the sample
+# array or the parameters of a live stream.
+AudioInfo = namedtuple("AudioInfo", ["samplerate", "channels", "frames", "duration"])
+
+# The window functions which can be applied to each time window before
+# the fft. Rectangular leaves the samples as they are.
+WINDOWS = {
+    name: getattr(numpy, function) if function else None
+    for name, function in options.WINDOWS.items()
+}
+
+# The number of window coefficient arrays kept, so a long running process
+# converting with many window sizes doesn't keep them all.
+WINDOW_CACHE_SIZE = 16
+
+
+@lru_cache(WINDOW_CACHE_SIZE)
+def window_coefficients(window, size, dtype=numpy.float64):
+    """
+    Returns the coefficients of the named window function for time
+        windows of size samples as a read only (size, 1) array of dtype,
+        or None for a rectangular window. They're scaled to a mean of 1,
+        so a sine wave keeps its velocity whatever the window.
+    """
+
+    if WINDOWS.get(window, False) is False:
+        raise RuntimeError("Unknown window function: {}".format(window))
+    if not WINDOWS[window]:
+        return None
+
+    coefficients = WINDOWS[window](size)
+    coefficients = (coefficients * (size / coefficients.sum()))[:, None].astype(dtype)
+    coefficients.setflags(write=False)
+    return coefficients
+
+
+ENGINES = options.ENGINES
+
+MIXES = options.MIXES
+
+
+def _array_blocks(samples, out, start=0, stop=None):
+    """
+    Like soundfile.blocks(out=out, fill_value=0), copies the sample frames
+        [start, stop) of a (frames, channels) array into out one block at
+        a time.
+    """
+
+    stop = len(samples) if stop is None else min(stop, len(samples))
+    for pos in range(start, stop, len(out)):
+        count = min(len(out), stop - pos)
+        out[:count] = samples[pos : pos + count]
+        out[count:] = 0
+        yield out
+
+
+def _sound_blocks(sound, out, start=0, stop=None):
+    """
+    Like _array_blocks(), for an open soundfile.SoundFile. The position is
+        set before every read, so several readers can share the file.
+    """
+
+    stop = sound.frames if stop is None else min(stop, sound.frames)
+    for pos in range(start, stop, len(out)):
+        count = min(len(out), stop - pos)
+        sound.seek(pos)
+        sound.read(out=out[:count], fill_value=0)
+        out[count:] = 0
+        yield out
 
 
 class Note:
@@ -25,6 +107,9 @@ class Converter:
         infile=None,
         outfile=None,
         time_window=None,
+        hop=None,
+        window="rectangular",
+        engine="fft",
         activation_level=None,
         condense=None,
         condense_max=False,
@@ -35,16 +120,63 @@ class Converter:
         note_count=None,
         progress=None,
         bpm=60,
+        batch_size=None,
+        jobs=1,
+        samplerate=None,
+        channels=None,
+        in_memory=True,
+        memory_map=True,
+        analysis_rate=None,
+        cache=None,
+        profiler=None,
+        samples=None,
+        fft_backend="numpy",
+        fft_workers=1,
+        float32=False,
+        gate=True,
+        checkpoint=None,
+        select_channels=None,
+        mix=None,
+        dedupe=True,
+        duplicate_tolerance=0.0,
     ):
 
-        if infile:
-            self.info = soundfile.info(infile)
+        # The input is opened once and its properties are taken from the
+        # open file, which is kept for reading.
+        self.sound = None
+        self.samples = None
+        if samples is not None:
+            if not samplerate:
+                raise RuntimeError("A samplerate is required with samples.")
+            self.samples = numpy.asarray(samples, dtype=numpy.float64)
+            if self.samples.ndim == 1:
+                self.samples = self.samples[:, None]
+            frames = len(self.samples)
+            self.info = AudioInfo(
+                samplerate, self.samples.shape[1], frames, frames / samplerate
+            )
+        elif infile is not None:
+            self.sound = soundfile.SoundFile(infile)
+            frames = self.sound.frames
+            self.info = AudioInfo(
+                self.sound.samplerate,
+                self.sound.channels,
+                frames,
+                frames / self.sound.samplerate,
+            )
+        elif samplerate and channels:
+            self.info = AudioInfo(samplerate, channels, 0, 0.0)
         else:
             raise RuntimeError("No input provided.")
 
         self.infile = infile
+        # Only paths can be hashed for the cache or reopened by workers.
+        self.path = infile if isinstance(infile, (str, os.PathLike)) else None
         self.outfile = outfile
         self.time_window = time_window
+        self.hop = hop or time_window
+        self.window = window
+        self.engine = engine
         self.condense = condense
         self.condense_max = condense_max
         self.max_note_length = max_note_length
@@ -54,45 +186,307 @@ class Converter:
         self.note_count = note_count
         self.progress = progress
         self.bpm = bpm
+        self.batch_size = batch_size
+        self.jobs = jobs
+        self.in_memory = in_memory
+        self.layout = (
+            pcm.layout(self.path, self.sound) if self.path and memory_map else None
+        )
+        self.cache = cache
+        self.profiler = profiler
+        self.fft = fft.Backend(fft_backend, fft_workers)
+        # The dtype of the samples and spectra analysed. Single precision
+        # halves the memory traffic of the analysis.
+        self.dtype = numpy.float32 if float32 else numpy.float64
+        self.gate = gate
+        # The number of time windows the energy gate skipped.
+        self.skipped = 0
+        self.select_channels = select_channels
+        self.mix = mix
+        self.dedupe = dedupe
+        self.duplicate_tolerance = duplicate_tolerance
+        # The number of windows of duplicate channels which were copied
+        # rather than analysed.
+        self.copied = 0
+        self._plan_channels()
+        self.checkpoint = checkpoint
+        # The number of time windows written so far.
+        self.position = 0
+        if checkpoint and not (self.path and in_memory):
+            raise RuntimeError("Checkpoints need an input path and in memory events.")
+
+        # The input is decimated to the analysis rate as it's read, and
+        # everything after the read works at that rate.
+        self.decimation = resample.decimation_factor(
+            self.info.samplerate, analysis_rate
+        )
+        self.samplerate = self.info.samplerate / self.decimation
+        self.frames = -(-self.info.frames // self.decimation)
 
         self.activation_level = int(127 * activation_level) or 1
         self.block_size = self._time_window_to_block_size(
-            self.time_window, self.info.samplerate
+            self.time_window, self.samplerate
         )
+        if self.block_size < 1:
+            raise RuntimeError(
+                "Time window shorter than a sample: {}".format(self.time_window)
+            )
+
+        self.hop_size = self._time_window_to_block_size(self.hop, self.samplerate)
+        if not 0 < self.hop_size <= self.block_size:
+            raise RuntimeError("Invalid hop: {}".format(self.hop))
 
-        steps = self.info.frames // self.block_size
+        # Time windows start every hop_size samples, and the ones which run
+        # past the end of the input are padded with zeros.
+        self.windows = -(-self.frames // self.hop_size)
+
+        steps = self.frames // self.hop_size
         self.total = steps
         self.current = 0
 
         self._determine_ranges()
 
+        if profiler:
+            profiler.instrument_converter(self)
+
+    def __getstate__(self):
+        # Worker processes never report progress or profile, and the
+        # profiling wrappers which shadow the methods can't be pickled.
+        state = {
+            name: value
+            for name, value in self.__dict__.items()
+            if not hasattr(value, "__wrapped__")
+        }
+        state["progress"] = None
+        state["profiler"] = None
+        state["sound"] = None
+        state["checkpoint"] = None
+        return state
+
+    def _plan_channels(self):
+        """
+        Works out how the input channels become the analysed channels,
+            which are the channels of every array after the read, and
+            the midi channel each of them is written to. Selected
+            channels keep their own midi channel, mixes start from 0.
+        """
+
+        indices = list(range(self.info.channels))
+        if self.select_channels is not None:
+            if not self.select_channels or len(set(self.select_channels)) != len(
+                self.select_channels
+            ):
+                raise RuntimeError(
+                    "Invalid channel selection: {}".format(self.select_channels)
+                )
+            for channel in self.select_channels:
+                if channel not in indices:
+                    raise RuntimeError("Invalid channel: {}".format(channel))
+            indices = list(self.select_channels)
+
+        # The input channels to keep, or the (input, analysed) matrix
+        # which mixes them.
+        self.channel_indices = None
+        self.channel_matrix = None
+
+        if self.mix is None:
+            if indices != list(range(self.info.channels)):
+                self.channel_indices = indices
+            self.midi_channels = indices
+        elif self.mix == "mono":
+            self.channel_matrix = numpy.zeros((self.info.channels, 1))
+            self.channel_matrix[indices, 0] = 1 / len(indices)
+            self.midi_channels = [0]
+        elif self.mix == "mid-side":
+            if len(indices) != 2:
+                raise RuntimeError("A mid/side mix needs two channels.")
+            self.channel_matrix = numpy.zeros((self.info.channels, 2))
+            self.channel_matrix[indices] = [[0.5, 0.5], [0.5, -0.5]]
+            self.midi_channels = [0, 1]
+        else:
+            raise RuntimeError("Unknown mix: {}".format(self.mix))
+
+        # A status byte holds a 4 bit channel, so higher channels would
+        # corrupt the events.
+        if max(self.midi_channels) > 15:
+            raise RuntimeError(
+                "MIDI files only have 16 channels, select channels 0 to 15 with --select-channels or mix them with --mix."
+            )
+
+        self.channels = len(self.midi_channels)
+
+    def _mix_channels(self, samples, out=None):
+        """
+        samples is an array of shape (frames, input channels).
+
+        Selects or mixes the analysed channels of samples, into out when
+            it's given.
+        """
+
+        if self.channel_matrix is not None:
+            return numpy.matmul(samples, self.channel_matrix, out=out)
+        if self.channel_indices is not None:
+            return numpy.take(samples, self.channel_indices, axis=1, out=out)
+        if out is None:
+            return samples
+        out[:] = samples
+        return out
+
+    def _distinct_channels(self, frames):
+        """
+        frames is an array of shape (frames, block_size, channels).
+
+        Returns the indices of the distinct channels of frames, and the
+            position among them of every channel's copy, or None when
+            each channel is distinct. Channels are copies when none of
+            their samples differ by more than duplicate_tolerance.
+        """
+
+        channels = frames.shape[2]
+        if not self.dedupe or channels == 1:
+            return None
+
+        # Only channels whose windows have about the same sums can be
+        # copies, which rules out distinct channels cheaply. The slack
+        # covers the rounding of the sums.
+        size = frames.shape[1]
+        sums = numpy.matmul(frames.transpose(0, 2, 1), numpy.ones(size, frames.dtype))
+        slack = (self.duplicate_tolerance + size * numpy.finfo(frames.dtype).eps) * size
+
+        unique = []
+        inverse = []
+        for channel in range(channels):
+            for index, other in enumerate(unique):
+                if numpy.abs(sums[:, channel] - sums[:, other]).max() > slack:
+                    continue
+                if self.duplicate_tolerance:
+                    difference = numpy.abs(frames[..., channel] - frames[..., other])
+                    same = difference.max() <= self.duplicate_tolerance
+                else:
+                    same = numpy.array_equal(frames[..., channel], frames[..., other])
+                if same:
+                    inverse.append(index)
+                    break
+            else:
+                inverse.append(len(unique))
+                unique.append(channel)
+
+        if len(unique) == channels:
+            return None
+        return unique, inverse
+
+    def _per_distinct_channel(self, function, frames):
+        """
+        frames is an array of shape (frames, block_size, channels), or
+            (block_size, channels) for a single window.
+
+        Returns function(frames), calling it with the distinct channels
+            of frames only and copying its results along the last axis
+            to the channels which duplicate them.
+        """
+
+        distinct = self._distinct_channels(frames if frames.ndim == 3 else frames[None])
+        if distinct is None:
+            return function(frames)
+
+        unique, inverse = distinct
+        self.copied += (len(inverse) - len(unique)) * (
+            len(frames) if frames.ndim == 3 else 1
+        )
+        return function(frames[..., unique])[..., inverse]
+
     def _determine_ranges(self):
-        self.notes = notes.generate()
-        self.max_freq = min(self.notes[127][-1], self.info.samplerate / 2)
-        self.min_freq = max(self.notes[0][-1], 1000 / self.time_window)
+        if self.engine not in ENGINES:
+            raise RuntimeError("Unknown analysis engine: {}".format(self.engine))
+
+        self.notes = notes.table()
         self.bins = self.block_size // 2
-        self.frequencies = numpy.fft.fftfreq(self.bins, 1 / self.info.samplerate)[
-            : self.bins // 2
-        ]
+        self.frequencies = numpy.fft.rfftfreq(self.block_size, 1 / self.samplerate)
+        self.coefficients = window_coefficients(
+            self.window, self.block_size, self.dtype
+        )
+        self.filterbank = None
 
-        for i, f in enumerate(self.frequencies):
-            if f >= self.min_freq:
-                self.min_bin = i
-                break
-        else:
+        if self.engine == "filterbank":
+            # The bands are the analysed bins. Only the pitches whose
+            # kernel of Q periods fits in the time window are analysed.
+            self.filterbank = filterbank.semitone(
+                self.samplerate,
+                self.block_size,
+                WINDOWS[self.window],
+                numpy.result_type(self.dtype, numpy.complex64).type,
+            )
+            if not self.filterbank:
+                raise RuntimeError(
+                    "Time window too short for the filterbank engine: {}".format(
+                        self.time_window
+                    )
+                )
+            self.coefficients = None
             self.min_bin = 0
-        for i, f in enumerate(self.frequencies):
-            if f >= self.max_freq:
-                self.max_bin = i
-                break
+            self.max_bin = len(self.filterbank)
+            pitches = self.filterbank.lowest + numpy.arange(self.max_bin)
+            self.min_freq = self.notes[pitches[0], 1]
+            self.max_freq = self.notes[pitches[-1], 1]
         else:
-            self.max_bin = len(self.frequencies)
+            self.max_freq = min(self.notes[127, -1], self.samplerate / 2)
+            self.min_freq = max(self.notes[0, -1], 1000 / self.time_window)
+            self.min_bin = int(numpy.searchsorted(self.frequencies, self.min_freq))
+            self.max_bin = int(numpy.searchsorted(self.frequencies, self.max_freq))
+            pitches = notes.freqs_to_pitches(
+                self.frequencies[self.min_bin : self.max_bin]
+            )
 
-    def _increment_progress(self):
+        # Map every analysed bin to its output pitch once, dropping the bins
+        # which fall outside of the allowed pitch range.
+        pitches = self._snap_to_key(pitches) + self.transpose
+        low = max(self.pitch_range[0], 0)
+        high = min(self.pitch_range[1], 127)
+        in_range = (pitches >= low) & (pitches <= high)
+        order = numpy.argsort(pitches[in_range], kind="stable")
+        self.bin_indices = numpy.arange(self.min_bin, self.max_bin)[in_range][order]
+        self.bin_pitches = pitches[in_range][order]
+
+        # The start of each run of bins sharing a pitch, for numpy.add.reduceat.
+        self.pitch_starts = numpy.flatnonzero(numpy.diff(self.bin_pitches, prepend=-1))
+        self.pitch_ids = self.bin_pitches[self.pitch_starts]
+
+        # No fft bin can exceed the L1 norm of the windowed samples, and no
+        # filterbank band the norm times the largest column sum of the
+        # matrix. A bin velocity only clears the activation level once
+        # the magnitude reaches (activation_level + 1) * bins / 127.
+        gain = 1.0
+        if self.filterbank:
+            gain = numpy.abs(self.filterbank.matrix).sum(axis=0).max()
+        margin = GATE_MARGIN + self.block_size * numpy.finfo(self.dtype).eps
+        self.gate_level = (
+            (self.activation_level + 1) * self.bins / 127 / (gain * margin)
+        )
+        self.gate_weights = (
+            numpy.ones(self.block_size, self.dtype)
+            if self.coefficients is None
+            else self.coefficients[:, 0]
+        )
+
+    def _increment_progress(self, count=1):
         if self.progress:
-            self.current += 1
+            self.current += count
             self.progress.update(self.current, self.total)
 
+    def _advance(self, writer, count=1):
+        """
+        Counts count more time windows as written, and saves a checkpoint
+            when one is due.
+        """
+
+        self.position += count
+        self._increment_progress(count)
+        if self.checkpoint and self.checkpoint.due():
+            self._save_checkpoint(writer)
+
+    def _save_checkpoint(self, writer):
+        self.checkpoint.save(self, writer)
+
     @staticmethod
     def _time_window_to_block_size(time_window, rate):
         """
@@ -111,29 +505,18 @@ class Converter:
 
     def _freqs_to_midi(self, freqs):
         """
-        freq_list is a list of frequencies with normalized amplitudes.
+        freqs is an array of 128 midi velocities produced by
+            _reduce_freqs().
 
-        Takes a list of notes and transforms the amplitude to a
-            midi volume as well as adding track and channel info.
+        Takes the per pitch velocities and transforms them into a
+            list of notes, keeping only the loudest note_count notes.
         """
 
-        notes = [None for _ in range(128)]
-        for pitch, velocity in freqs:
-            if not (self.pitch_range[0] <= pitch <= self.pitch_range[1]):
-                continue
-            velocity = min(int(127 * (velocity / self.bins)), 127)
-
-            if velocity > self.activation_level:
-                if not notes[pitch]:
-                    notes[pitch] = Note(pitch, velocity)
-                else:
-                    notes[pitch].velocity = int(
-                        ((notes[pitch].velocity * notes[pitch].count) + velocity)
-                        / (notes[pitch].count + 1)
-                    )
-                    notes[pitch].count += 1
-
-        notes = [note for note in notes if note]
+        pitches = numpy.flatnonzero(freqs)
+        notes = [
+            Note(pitch, velocity)
+            for pitch, velocity in zip(pitches.tolist(), freqs[pitches].tolist())
+        ]
 
         if self.note_count > 0:
             max_count = min(len(notes), self.note_count)
@@ -141,106 +524,652 @@ class Converter:
 
         return notes
 
-    def _snap_to_key(self, pitch):
-        if self.pitch_set:
-            mod = pitch % 12
-            pitch = (12 * (pitch // 12)) + min(
-                self.pitch_set, key=lambda x: abs(x - mod)
-            )
-        return pitch
+    def _snap_to_key(self, pitches):
+        """
+        pitches is an array of midi notes.
 
-    @lru_cache(None)
-    def _freq_to_pitch(self, freq):
-        for pitch, freq_range in self.notes.items():
-            # Find the freq's equivalence class, adding the amplitudes.
-            if freq_range[0] <= freq <= freq_range[2]:
-                return self._snap_to_key(pitch) + self.transpose
-        raise RuntimeError("Unmappable frequency: {}".format(freq[0]))
+        Moves every pitch to the closest pitch class in pitch_set within
+            its octave.
+        """
+
+        if not self.pitch_set:
+            return pitches
 
-    def _reduce_freqs(self, freqs):
+        classes = numpy.array(
+            [min(self.pitch_set, key=lambda x: abs(x - mod)) for mod in range(12)]
+        )
+        return 12 * (pitches // 12) + classes[pitches % 12]
+
+    def _amplitudes_to_velocities(self, amplitudes):
+        """
+        Scales fft magnitudes to midi velocities in [0, 127].
         """
-        freqs is a list of amplitudes produced by _fft_to_frequencies().
 
-        Reduces the list of frequencies to a list of notes and their
-            respective volumes by determining what note each frequency
-            is closest to. It then reduces the list of amplitudes for each
-            note to a single amplitude by summing them together.
+        return numpy.minimum((127 * (amplitudes / self.bins)).astype(int), 127)
+
+    def _reduce_freqs(self, amplitudes, axis=0):
+        """
+        amplitudes is an array of magnitudes for each bin in bin_indices,
+            laid out along the given axis.
+
+        Reduces the bin magnitudes to a midi velocity for each of the 128
+            notes, see _reduce_velocities().
         """
 
-        reduced_freqs = []
-        for freq in freqs:
-            reduced_freqs.append((self._freq_to_pitch(freq[0]), freq[1]))
+        return self._reduce_velocities(
+            self._amplitudes_to_velocities(amplitudes), axis=axis
+        )
 
-        return reduced_freqs
+    def _reduce_velocities(self, velocities, axis=0):
+        """
+        velocities is an array of velocities for each bin in bin_indices,
+            laid out along the given axis.
+
+        Reduces the bin velocities to a midi velocity for each of the 128
+            notes by averaging the velocities of the bins which map to
+            that note and clear the activation level. Notes without any
+            active bins are given a velocity of 0.
+        """
+
+        velocities = numpy.where(velocities > self.activation_level, velocities, 0)
+
+        shape = list(velocities.shape)
+        shape[axis] = 128
+        reduced = numpy.zeros(shape, dtype=int)
+        if not len(self.pitch_ids):
+            return reduced
+
+        totals = numpy.add.reduceat(velocities, self.pitch_starts, axis=axis, dtype=int)
+        counts = numpy.add.reduceat(
+            velocities > 0, self.pitch_starts, axis=axis, dtype=int
+        )
+        numpy.moveaxis(reduced, axis, 0)[self.pitch_ids] = numpy.moveaxis(
+            totals // numpy.maximum(counts, 1), axis, 0
+        )
+
+        return reduced
 
     def _samples_to_freqs(self, samples):
-        amplitudes = numpy.fft.fft(samples)
-        freqs = []
-
-        for index in range(self.min_bin, self.max_bin):
-            # frequency, amplitude
-            freqs.append(
-                [
-                    self.frequencies[index],
-                    numpy.sqrt(
-                        numpy.float_power(amplitudes[index].real, 2)
-                        + numpy.float_power(amplitudes[index].imag, 2)
-                    ),
-                ]
-            )
+        """
+        samples is an array of shape (block_size, channels).
+
+        Performs the fft of every distinct channel along axis 0 and
+            returns the per pitch velocities with the shape
+            (128, channels).
+        """
+
+        return self._per_distinct_channel(self._gated_freqs, samples)
+
+    def _gated_freqs(self, samples):
+        if self.gate and not self._gate(samples[None])[0]:
+            self.skipped += 1
+            return numpy.zeros((128, samples.shape[1]), dtype=int)
+
+        amplitudes = self._frames_to_amplitudes(samples[None])[0]
 
         # Transform the frequency info into midi compatible data.
-        return self._reduce_freqs(freqs)
+        return self._reduce_freqs(amplitudes)
 
     def _block_to_notes(self, block):
-        channels = [[] for _ in range(self.info.channels)]
-        notes = [None for _ in range(self.info.channels)]
+        freqs = self._samples_to_freqs(block)
+        return [
+            self._freqs_to_midi(freqs[:, channel]) for channel in range(self.channels)
+        ]
 
-        for sample in block:
-            for channel in range(self.info.channels):
-                channels[channel].append(sample[channel])
+    def _select_notes(self, velocities):
+        """
+        velocities is an array of shape (frames, 128, channels).
+
+        Silences all but the loudest note_count notes of every frame
+            and channel. Ties are broken in favour of the higher pitch.
+        """
+
+        if not 0 < self.note_count < 128:
+            return velocities
 
-        for channel, samples in enumerate(channels):
-            freqs = self._samples_to_freqs(samples)
-            notes[channel] = self._freqs_to_midi(freqs)
+        keys = velocities * 128 + numpy.arange(128)[:, None]
+        index = 128 - self.note_count
+        threshold = numpy.partition(keys, index, axis=1)[:, index : index + 1]
+
+        return numpy.where(keys >= threshold, velocities, 0)
+
+    def _velocities_to_notes(self, velocities):
+        """
+        velocities is an array of shape (frames, 128, channels).
+
+        Transforms the velocities into a list of per channel note lists
+            for each frame, ordered the same way as _freqs_to_midi().
+        """
+
+        frames, pitches, channels = numpy.nonzero(velocities)
+        values = velocities[frames, pitches, channels].astype(int)
+        if self.note_count > 0:
+            order = numpy.lexsort((-(values * 128 + pitches), channels, frames))
+        else:
+            order = numpy.lexsort((pitches, channels, frames))
+
+        notes = [[[] for _ in range(self.channels)] for _ in velocities]
+        for frame, channel, pitch, velocity in zip(
+            frames[order].tolist(),
+            channels[order].tolist(),
+            pitches[order].tolist(),
+            values[order].tolist(),
+        ):
+            notes[frame][channel].append(Note(pitch, velocity))
 
         return notes
 
+    def _fft(self, frames):
+        """
+        Returns the spectrum of every frame along axis 1, which is either
+            the rfft bins or the filterbank bands.
+        """
+
+        if frames.dtype != self.dtype:
+            frames = frames.astype(self.dtype)
+        if self.coefficients is not None:
+            frames = frames * self.coefficients
+        spectrum = self.fft.rfft(frames)
+        if self.filterbank:
+            spectrum = self.filterbank.apply(spectrum)
+        return spectrum
+
+    def _frames_to_amplitudes(self, frames):
+        """
+        frames is an array of shape (frames, block_size, channels).
+
+        Returns the magnitudes of the bins in bin_indices with the
+            shape (frames, bins, channels). The bins are filterbank bands
+            with the filterbank engine.
+        """
+
+        return numpy.abs(self._fft(frames)[:, self.bin_indices])
+
+    def _frames_to_spectrum(self, frames):
+        """
+        frames is an array of shape (frames, block_size, channels).
+
+        Returns the velocities of every bin in [min_bin, max_bin) as a
+            uint8 array of shape (frames, bins, channels), whatever the
+            pitch mapping. This is what the spectral cache stores.
+        """
+
+        amplitudes = numpy.abs(self._fft(frames)[:, self.min_bin : self.max_bin])
+        return self._amplitudes_to_velocities(amplitudes).astype(numpy.uint8)
+
+    def _cached_spectrum(self):
+        """
+        Returns the spectrum of the whole input from the cache, computing
+            and storing it first on a miss.
+        """
+
+        key = self.cache.key(
+            self.path,
+            self.samplerate,
+            self.block_size,
+            self.hop_size,
+            self.window,
+            self.engine,
+            self.min_bin,
+            self.max_bin,
+            self.fft.name,
+            numpy.dtype(self.dtype).name,
+            self.mix,
+            self.midi_channels if self.mix is None else self.select_channels,
+            self.duplicate_tolerance if self.dedupe else 0.0,
+            # The filter shapes the spectra of decimated inputs.
+            resample.lowpass(self.decimation).tolist() if self.decimation > 1 else None,
+        )
+        spectrum = self.cache.load(key)
+        if spectrum is not None:
+            logging.info("spectral cache: hit")
+            return spectrum
+
+        logging.info("spectral cache: miss")
+        shape = (self.windows, self.max_bin - self.min_bin, self.channels)
+        with self.cache.create(key, shape) as spectrum:
+            pos = 0
+            for frames in self._read_frames():
+                spectrum[pos : pos + len(frames)] = self._per_distinct_channel(
+                    self._frames_to_spectrum, frames
+                )
+                pos += len(frames)
+
+        return spectrum
+
+    def _convert_cached(self, writer, start=0):
+        """
+        Converts the input from its cached spectrum, one batch of windows
+            at a time.
+        """
+
+        spectrum = self._cached_spectrum()
+        batch_size = self.batch_size or DEFAULT_BATCH_SIZE
+
+        for start in range(start, len(spectrum), batch_size):
+            self._write_spectrum(writer, spectrum[start : start + batch_size])
+
+    def _spectrum_to_velocities(self, spectrum):
+        """
+        spectrum is a batch of bin velocities as returned by
+            _frames_to_spectrum().
+
+        Returns the per pitch velocities of the batch, before the notes
+            are selected.
+        """
+
+        return self._reduce_velocities(
+            spectrum[:, self.bin_indices - self.min_bin], axis=1
+        )
+
+    def _write_spectrum(self, writer, spectrum):
+        velocities = self._spectrum_to_velocities(spectrum)
+        self._write_velocities(writer, self._select_notes(velocities))
+
+    def _gate(self, frames):
+        """
+        frames is an array of shape (frames, block_size, channels).
+
+        Returns a boolean array which is False for the frames whose
+            magnitudes can't clear the activation level in any channel,
+            judged from the L1 norm of their windowed samples.
+        """
+
+        # A matrix product sums the strided windows far faster than sum().
+        magnitudes = numpy.abs(frames.transpose(0, 2, 1))
+        norms = numpy.matmul(magnitudes, self.gate_weights)
+        return (norms >= self.gate_level).any(axis=1)
+
+    def _frames_to_velocities(self, frames):
+        """
+        frames is an array of shape (frames, block_size, channels).
+
+        Performs the fft for every frame and distinct channel in a
+            single call and returns the selected velocities with the
+            shape (frames, 128, channels). Frames which the energy gate
+            rejects skip the fft and are silent.
+        """
+
+        return self._per_distinct_channel(self._gated_velocities, frames)
+
+    def _gated_velocities(self, frames):
+        if self.gate:
+            active = self._gate(frames)
+            skipped = len(frames) - numpy.count_nonzero(active)
+            if skipped:
+                self.skipped += skipped
+                velocities = numpy.zeros((len(frames), 128, frames.shape[2]), dtype=int)
+                if skipped < len(frames):
+                    velocities[active] = self._analyse_frames(frames[active])
+                return velocities
+
+        return self._analyse_frames(frames)
+
+    def _gated_spectrum(self, frames):
+        """
+        Like _frames_to_spectrum(), for the frames which the energy gate
+            lets through and their distinct channels. The other frames
+            are silent.
+        """
+
+        return self._per_distinct_channel(self._gated_bins, frames)
+
+    def _gated_bins(self, frames):
+        if not self.gate:
+            return self._frames_to_spectrum(frames)
+
+        active = self._gate(frames)
+        self.skipped += len(frames) - numpy.count_nonzero(active)
+        spectrum = numpy.zeros(
+            (len(frames), self.max_bin - self.min_bin, frames.shape[2]),
+            dtype=numpy.uint8,
+        )
+        if active.any():
+            spectrum[active] = self._frames_to_spectrum(frames[active])
+        return spectrum
+
+    def _analyse_frames(self, frames):
+        amplitudes = self._frames_to_amplitudes(frames)
+        return self._select_notes(self._reduce_freqs(amplitudes, axis=1))
+
+    def _blocks(self, out, start=0, stop=None):
+        """
+        Reads the sample frames [start, stop) of the input at the analysis
+            rate into out one block at a time, padding the last block with
+            zeros.
+        """
+
+        if self.decimation > 1:
+            return self._decimated_blocks(out, start, stop)
+        return self._read_input(out, start, stop)
+
+    def _decimated_blocks(self, out, start=0, stop=None):
+        """
+        Decimates the input as it's read. The filter history before start
+            is read from the input, so any range gives the same samples
+            as decimating the whole input.
+        """
+
+        stop = self.frames if stop is None else stop
+        if start >= stop:
+            return
+        delay = len(resample.lowpass(self.decimation)) // 2
+
+        # Each output sample is centred on input sample n * decimation.
+        first = start * self.decimation
+        last = min((stop - 1) * self.decimation + delay + 1, self.info.frames)
+        history = numpy.zeros((min(delay, first), self.channels))
+        if len(history):
+            next(self._read_input(history, first - len(history), first))
+        decimator = resample.Decimator(
+            self.decimation, self.channels, history, self.dtype
+        )
+
+        remaining = stop - start
+        filled = 0
+        source = numpy.zeros((len(out) * self.decimation, self.channels))
+        chunks = self._read_input(source, first, last) if first < last else ()
+        for chunk in chunks:
+            outputs = decimator.process(chunk)
+            while len(outputs) and remaining:
+                count = min(len(out) - filled, len(outputs), remaining)
+                out[filled : filled + count] = outputs[:count]
+                outputs = outputs[count:]
+                filled += count
+                remaining -= count
+                if filled == len(out):
+                    yield out
+                    filled = 0
+
+        if remaining:
+            outputs = decimator.flush(remaining)
+            while remaining:
+                count = min(len(out) - filled, remaining)
+                out[filled : filled + count] = outputs[:count]
+                outputs = outputs[count:]
+                filled += count
+                remaining -= count
+                if filled == len(out) or not remaining:
+                    out[filled:] = 0
+                    yield out
+                    filled = 0
+        elif filled:
+            out[filled:] = 0
+            yield out
+
+    def _read_input(self, out, start=0, stop=None):
+        """
+        Reads the analysed channels of the input into out one block at a
+            time.
+        """
+
+        if self.channel_indices is None and self.channel_matrix is None:
+            return self._read_source(out, start, stop)
+        return self._mixed_blocks(out, start, stop)
+
+    def _mixed_blocks(self, out, start=0, stop=None):
+        """
+        Reads every channel into a buffer of its own and selects or mixes
+            the analysed channels into out.
+        """
+
+        source = numpy.zeros((len(out), self.info.channels), out.dtype)
+        for block in self._read_source(source, start, stop):
+            self._mix_channels(block, out)
+            yield out
+
+    def _read_source(self, out, start=0, stop=None):
+        """
+        Reads every channel of the input into out one block at a time,
+            straight from a memory map when it's uncompressed PCM and
+            through soundfile otherwise.
+        """
+
+        if self.samples is not None:
+            return _array_blocks(self.samples, out, start, stop)
+        if self.layout:
+            return pcm.blocks(self.layout, out, start, stop)
+        if self.sound is None:
+            # Worker processes reopen the input.
+            self.sound = soundfile.SoundFile(self.path)
+        return _sound_blocks(self.sound, out, start, stop)
+
+    def _read_frames(self, start=0, stop=None):
+        """
+        Reads batch_size time windows at a time from the window range
+            [start, stop) into a reused buffer, and yields them as a
+            strided (frames, block_size, channels) view of it. Windows
+            overlap when the hop is shorter than the time window, and
+            the samples they share are carried over rather than read
+            again. Windows which run past the end of the input are
+            padded with zeros.
+        """
+
+        batch_size = self.batch_size or DEFAULT_BATCH_SIZE
+        stop = self.windows if stop is None else stop
+        if start >= stop:
+            return
+        overlap = self.block_size - self.hop_size
+
+        first = start * self.hop_size
+        last = min((stop - 1) * self.hop_size + self.block_size, self.frames)
+
+        # The view yielded is only valid until the next chunk is read.
+        buffer = numpy.zeros(
+            (self.hop_size * batch_size + overlap, self.channels), self.dtype
+        )
+        frames = numpy.lib.stride_tricks.sliding_window_view(
+            buffer, self.block_size, axis=0
+        )[:: self.hop_size].transpose(0, 2, 1)
+
+        if overlap:
+            head = buffer[:overlap]
+            next(self._blocks(head, first, min(first + overlap, last)), None)
+        chunks = self._blocks(buffer[overlap:], min(first + overlap, last), last)
+
+        for pos in range(start, stop, batch_size):
+            if next(chunks, None) is None:
+                buffer[overlap:] = 0
+            yield frames[: min(batch_size, stop - pos)]
+            if overlap:
+                buffer[:overlap] = buffer[-overlap:]
+
+    def _read_blocks(self, start=0):
+        """
+        Reads one time window at a time from the window start on into a
+            reused buffer, padding the last one with zeros in place.
+        """
+
+        if self.hop_size < self.block_size:
+            for frames in self._read_frames(start):
+                yield from frames
+            return
+
+        buffer = numpy.zeros((self.block_size, self.channels), self.dtype)
+        yield from self._blocks(buffer, start * self.hop_size)
+
+    def _write_velocities(self, writer, velocities):
+        if isinstance(writer, midi_writer.MemoryMidiWriter):
+            writer.add_frames(velocities, by_velocity=self.note_count > 0)
+            self._advance(writer, len(velocities))
+            return
+
+        for notes in self._velocities_to_notes(velocities):
+            writer.add_notes(notes)
+            self._advance(writer)
+
+    def _convert_batches(self, writer, start=0):
+        for frames in self._read_frames(start):
+            self._write_velocities(writer, self._frames_to_velocities(frames))
+
+    def _convert_parallel(self, writer, start=0):
+        """
+        Splits the input into contiguous segments of time windows
+            which are analysed by a pool of jobs worker processes. Each
+            worker reads its own segment from the input file, and the
+            results are handed to the writer in order so the output
+            matches a serial conversion.
+        """
+
+        # Importing the process pool pulls in multiprocessing, which serial
+        # conversions don't need.
+        from concurrent.futures import ProcessPoolExecutor
+
+        batch_size = self.batch_size or DEFAULT_BATCH_SIZE
+        segment_size = batch_size * SEGMENT_BATCHES
+
+        with ProcessPoolExecutor(
+            max_workers=self.jobs, initializer=_init_worker, initargs=(self,)
+        ) as executor:
+            pending = deque()
+            for start in range(start, self.windows, segment_size):
+                stop = min(start + segment_size, self.windows)
+                pending.append(executor.submit(_analyse_segment, start, stop))
+                # Bound the number of finished segments held in memory.
+                if len(pending) > 2 * self.jobs:
+                    self._write_segment(writer, pending.popleft().result())
+            while pending:
+                self._write_segment(writer, pending.popleft().result())
+
+    def _write_segment(self, writer, result):
+        velocities, skipped, copied = result
+        self.skipped += skipped
+        self.copied += copied
+        self._write_velocities(writer, velocities)
+
+    def _create_writer(self, stream=None):
+        """
+        Creates the MidiWriter for the output. Events are kept in memory
+            and written in one go unless in_memory is disabled or a
+            stream is given to write them to as they're added.
+        """
+
+        if self.in_memory and stream is None:
+            cls = midi_writer.MemoryMidiWriter
+        else:
+            cls = midi_writer.MidiWriter
+
+        writer = cls(
+            outfile=self.outfile,
+            channels=self.channels,
+            channel_map=self.midi_channels,
+            # Events are spaced by the hop between time windows.
+            time_window=self.hop,
+            bpm=self.bpm,
+            condense=self.condense,
+            condense_max=self.condense_max,
+            max_note_length=self.max_note_length,
+            stream=stream,
+        )
+        if self.profiler:
+            self.profiler.instrument_writer(writer)
+
+        return writer
+
     def convert(self):
         """
         Performs the fft for each time step and transforms the result
             into midi compatible data. This data is then passed to a
-            midi file writer.
+            midi file writer, which is returned.
         """
 
         logging.info(str(self.info))
-        logging.info("window: {} ms".format(self.time_window))
+        logging.info("window: {} ms, {}".format(self.time_window, self.window))
+        logging.info("hop: {} ms".format(self.hop))
+        if self.decimation > 1:
+            logging.info(
+                "analysis rate: {} Hz, decimated by {}".format(
+                    self.samplerate, self.decimation
+                )
+            )
         logging.info(
             "frequencies: min = {} Hz, max = {} Hz".format(self.min_freq, self.max_freq)
         )
 
-        with midi_writer.MidiWriter(
-            outfile=self.outfile,
-            channels=self.info.channels,
-            time_window=self.time_window,
-            bpm=self.bpm,
-            condense=self.condense,
-            condense_max=self.condense_max,
-            max_note_length=self.max_note_length,
-        ) as writer:
-            for block in soundfile.blocks(
-                self.infile,
-                blocksize=self.block_size,
-                always_2d=True,
-            ):
-                if len(block) != self.block_size:
-                    filler = numpy.array(
-                        [
-                            numpy.array([0.0 for _ in range(self.info.channels)])
-                            for _ in range(self.block_size - len(block))
-                        ]
-                    )
-                    block = numpy.append(block, filler, axis=0)
+        with self._create_writer() as writer:
+            start = self.checkpoint.start(self, writer) if self.checkpoint else 0
+            self.position = self.current = start
+            self._convert(writer, start)
+        if self.checkpoint:
+            self.checkpoint.remove()
+
+        if self.gate:
+            logging.info(
+                "energy gate: skipped {} of {} windows".format(
+                    self.skipped, self.windows
+                )
+            )
+        if self.dedupe and self.channels > 1:
+            logging.info(
+                "duplicate channels: copied {} of {} channel windows".format(
+                    self.copied, self.windows * self.channels
+                )
+            )
+
+        return writer
+
+    def _cached(self):
+        return bool(self.cache and self.frames and self.path)
+
+    def _parallel(self):
+        return bool(self.jobs > 1 and self.path)
+
+    def _batched(self):
+        """
+        Returns whether the windows are converted in batches, rather than
+            one at a time.
+        """
+
+        return bool(self._cached() or self._parallel() or self.batch_size)
+
+    def _convert(self, writer, start=0):
+        """
+        Converts the time windows from start on.
+        """
+
+        if self._cached():
+            self._convert_cached(writer, start)
+        elif self._parallel():
+            self._convert_parallel(writer, start)
+        elif self.batch_size:
+            self._convert_batches(writer, start)
+        else:
+            for block in self._read_blocks(start):
                 notes = self._block_to_notes(block)
                 writer.add_notes(notes)
-                self._increment_progress()
+                self._advance(writer)
+
+
+_worker_converter = None
+
+
+def _init_worker(converter):
+    global _worker_converter
+    _worker_converter = converter
+    # Forked workers inherit the parent's open sound file rather than a
+    # pickled copy, and the file position it shares between processes
+    # would race, so each worker opens its own.
+    converter.sound = None
+
+
+def _analyse_segment(start, stop):
+    """
+    Analyses the time windows [start, stop) of the worker's input and
+        returns the selected velocities as a compact uint8 array, with
+        the number of windows the energy gate skipped and of channel
+        windows copied from duplicate channels.
+    """
+
+    skipped = _worker_converter.skipped
+    copied = _worker_converter.copied
+    velocities = numpy.concatenate(
+        [
+            _worker_converter._frames_to_velocities(frames).astype(numpy.uint8)
+            for frames in _worker_converter._read_frames(start, stop)
+        ]
+    )
+    return (
+        velocities,
+        _worker_converter.skipped - skipped,
+        _worker_converter.copied - copied,
+    )
@@ -0,0 +1,359 @@
+import numpy
+
+NOTE_ON = 0x90
+NOTE_OFF = 0x80
+
+# A note event with an absolute tick, as stored by MemoryMidiWriter.
+EVENT_DTYPE = numpy.dtype(
+    [
+        ("tick", "<u4"),
+        ("type", "u1"),
+        ("channel", "u1"),
+        ("pitch", "u1"),
+        ("velocity", "u1"),
+    ]
+)
+
+# A note with its start tick and its length in ticks, as returned by
+# pair_notes().
+NOTE_DTYPE = numpy.dtype(
+    [
+        ("tick", "<u4"),
+        ("channel", "u1"),
+        ("pitch", "u1"),
+        ("velocity", "u1"),
+        ("duration", "<u4"),
+    ]
+)
+
+_UNSEEN = numpy.iinfo(numpy.int64).max
+_MISSING = numpy.iinfo(numpy.int64).min
+
+
+class EventCompiler:
+    """
+    Compiles whole (frames, 128, channels) velocity arrays into sorted
+        EVENT_DTYPE arrays, following the same rules as
+        MidiWriter.add_notes() so the output is identical.
+
+    Notes are handled as one (channel, pitch) key per row and one frame
+        per column, so the cost grows with the number of events rather
+        than with frames * active notes. State carries over between
+        calls, so a file can be compiled one batch at a time.
+    """
+
+    def __init__(
+        self,
+        channels,
+        tick_increment,
+        condense=False,
+        condense_max=False,
+        max_note_length=0,
+        by_velocity=False,
+        channel_map=None,
+    ):
+        self.channels = channels
+        self.tick_increment = tick_increment
+        self.condense = condense
+        self.condense_max = condense_max
+        self.segment_length = max_note_length + 1
+        self.by_velocity = by_velocity
+        # The midi channel of each channel of the velocities.
+        self.channel_map = numpy.array(
+            range(channels) if channel_map is None else channel_map, dtype=numpy.uint8
+        )
+
+        keys = 128 * channels
+        self.frame = 0
+        self.emitted = False
+        # MidiWriter orders note offs by when each key was first seen.
+        self.rank = numpy.full(keys, _UNSEEN, dtype=numpy.int64)
+        self.active = numpy.zeros(keys, dtype=bool)
+        self.count = numpy.zeros(keys, dtype=numpy.int64)
+        self.total = numpy.zeros(keys, dtype=numpy.int64)
+        self.peak = numpy.zeros(keys, dtype=numpy.int64)
+        self.pos = numpy.zeros(keys, dtype=numpy.int64)
+
+    def _order(self, velocities):
+        """
+        Returns the position of each note within its frame's note list,
+            loudest first when notes are selected by velocity.
+        """
+
+        pitches = numpy.arange(len(velocities)) % 128
+        if self.by_velocity:
+            return (127 - velocities) * 128 + (127 - pitches)[:, None]
+        return numpy.broadcast_to(pitches[:, None], velocities.shape)
+
+    def _events(self, keys, frames, phases, subs, velocities, types):
+        channels = keys // 128
+        if self.condense:
+            order = numpy.lexsort((subs, phases, channels, frames))
+        else:
+            order = numpy.lexsort((subs, channels, phases, frames))
+
+        events = numpy.empty(len(order), dtype=EVENT_DTYPE)
+        events["tick"] = self.tick_increment * (frames[order] + 1)
+        events["type"] = types[order]
+        events["channel"] = self.channel_map[channels[order]]
+        events["pitch"] = keys[order] % 128
+        events["velocity"] = velocities[order]
+        return events, order
+
+    def compile(self, velocities, base=0):
+        """
+        velocities is an array of shape (frames, 128, channels).
+        base is the position the first event will be stored at.
+
+        Returns the sorted events of the frames, and the positions and
+            new velocities of events from earlier calls whose condensed
+            velocities changed.
+        """
+
+        count = len(velocities)
+        if not count:
+            return numpy.empty(0, dtype=EVENT_DTYPE), [], []
+
+        values = velocities.transpose(2, 1, 0).reshape(-1, count).astype(numpy.int64)
+        present = values > 0
+        order = self._order(values)
+        frames = numpy.arange(count)
+
+        seen = present.any(axis=1) & (self.rank == _UNSEEN)
+        first = numpy.argmax(present[seen], axis=1)
+        self.rank[seen] = (self.frame + first) * (1 << 14) + order[seen, first]
+
+        if self.condense:
+            result = self._compile_condensed(values, present, order, base)
+        else:
+            result = self._compile_plain(values, present, order)
+
+        self.frame += count
+        return result
+
+    def _compile_plain(self, values, present, order):
+        # Every note lasts one frame and is turned off at the start of
+        # the next one.
+        on_keys, on_frames = numpy.nonzero(present)
+        off_keys, off_frames = numpy.nonzero(present[:, :-1])
+        carried = numpy.flatnonzero(self.active)
+
+        keys = numpy.concatenate([carried, off_keys, on_keys])
+        frames = numpy.concatenate(
+            [numpy.zeros(len(carried), dtype=numpy.int64), off_frames + 1, on_frames]
+        )
+        offs = len(carried) + len(off_keys)
+        phases = numpy.repeat([0, 1], [offs, len(on_keys)])
+        subs = numpy.concatenate([self.rank[keys[:offs]], order[on_keys, on_frames]])
+        velocities = numpy.concatenate(
+            [numpy.zeros(offs, dtype=numpy.int64), values[on_keys, on_frames]]
+        )
+        types = numpy.where(phases, NOTE_ON, NOTE_OFF)
+
+        self.active = present[:, -1].copy()
+        self.emitted = bool(numpy.any(frames == present.shape[1] - 1))
+
+        events, _ = self._events(
+            keys, self.frame + frames, phases, subs, velocities, types
+        )
+        return events, [], []
+
+    def _compile_condensed(self, values, present, order, base):
+        keys, count = values.shape
+        frames = numpy.arange(count)
+        length = self.segment_length
+
+        # A run of present frames continues a note which was still
+        # sounding at the end of the last call.
+        previous = numpy.empty_like(present)
+        previous[:, 0] = self.active
+        previous[:, 1:] = present[:, :-1]
+        starts = present & ~previous
+
+        # g is the position of each present frame within its note,
+        # counting the frames from earlier calls.
+        last_start = numpy.maximum.accumulate(
+            numpy.where(starts, frames, _MISSING), axis=1
+        )
+        carried = last_start == _MISSING
+        last_start = numpy.where(carried, -self.count[:, None], last_start)
+        g = (frames - last_start) % length
+
+        on = present & (g == 0)
+        full = present & (g == length - 1)
+        # A note which wasn't cut by max_note_length ends on the first
+        # frame it's missing from.
+        open_before = numpy.empty_like(present)
+        open_before[:, 0] = self.active
+        open_before[:, 1:] = present[:, :-1] & ~full[:, :-1]
+        missing = open_before & ~present
+
+        on_keys, on_frames = numpy.nonzero(on)
+        full_keys, full_frames = numpy.nonzero(full)
+        missing_keys, missing_frames = numpy.nonzero(missing)
+
+        # Sum the velocities of every segment of a note, the segments
+        # started before this call being labelled -1.
+        segment = numpy.maximum.accumulate(numpy.where(on, frames, -1), axis=1)
+        segment = numpy.where(present, segment, -2)
+        present_keys, present_frames = numpy.nonzero(present)
+        labels = present_keys * (count + 1) + segment[present_keys, present_frames] + 1
+        bounds = numpy.flatnonzero(numpy.diff(labels, prepend=-1))
+        group_keys = present_keys[bounds]
+        group_starts = segment[present_keys, present_frames][bounds]
+        present_values = values[present_keys, present_frames]
+
+        totals = numpy.add.reduceat(present_values, bounds) if len(bounds) else bounds
+        counts = numpy.diff(numpy.append(bounds, len(labels)))
+        peaks = (
+            numpy.maximum.reduceat(present_values, bounds) if len(bounds) else bounds
+        )
+
+        continued = group_starts == -1
+        totals = totals + numpy.where(continued, self.total[group_keys], 0)
+        counts = counts + numpy.where(continued, self.count[group_keys], 0)
+        peaks = numpy.maximum(peaks, numpy.where(continued, self.peak[group_keys], 0))
+        if self.condense_max:
+            results = peaks
+        else:
+            results = totals // counts
+
+        ons = len(on_keys)
+        off_keys = numpy.concatenate([full_keys, missing_keys])
+        event_keys = numpy.concatenate([on_keys, off_keys])
+        event_frames = numpy.concatenate([on_frames, full_frames, missing_frames])
+        phases = numpy.repeat([0, 1], [ons, len(off_keys)])
+        subs = numpy.concatenate([order[on_keys, on_frames], self.rank[off_keys]])
+        velocities = numpy.zeros(len(event_keys), dtype=numpy.int64)
+        types = numpy.where(phases, NOTE_OFF, NOTE_ON)
+
+        # Segments started in this call write their velocity into their
+        # own note on, the others update the events of earlier calls.
+        group_ids = group_keys * (count + 1) + group_starts + 1
+        on_groups = numpy.searchsorted(group_ids, on_keys * (count + 1) + on_frames + 1)
+        velocities[:ons] = results[on_groups]
+
+        events, event_order = self._events(
+            event_keys, self.frame + event_frames, phases, subs, velocities, types
+        )
+        positions = numpy.empty(len(event_order), dtype=numpy.int64)
+        positions[event_order] = base + numpy.arange(len(event_order))
+
+        update_positions = self.pos[group_keys[continued]].tolist()
+        update_velocities = results[continued].tolist()
+
+        # Carry the notes still sounding after the last frame.
+        last = count - 1
+        self.active = present[:, last] & ~full[:, last]
+        self.emitted = bool(numpy.any(event_frames == last))
+
+        sounding = numpy.flatnonzero(self.active)
+        sounding_groups = numpy.searchsorted(
+            group_ids, sounding * (count + 1) + segment[sounding, last] + 1
+        )
+        self.count[:] = 0
+        self.total[:] = 0
+        self.peak[:] = 0
+        self.count[sounding] = g[sounding, last] + 1
+        self.total[sounding] = totals[sounding_groups]
+        self.peak[sounding] = peaks[sounding_groups]
+
+        restarted = sounding[segment[sounding, last] >= 0]
+        restarted_ons = numpy.searchsorted(
+            on_keys * (count + 1) + on_frames,
+            restarted * (count + 1) + segment[restarted, last],
+        )
+        self.pos[restarted] = positions[restarted_ons]
+
+        return events, update_positions, update_velocities
+
+    def finish(self):
+        """
+        Returns the note offs of the notes still sounding at the end of
+            the input, as MidiWriter's exit would write them.
+        """
+
+        keys = numpy.flatnonzero(self.active)
+        keys = keys[numpy.lexsort((self.rank[keys], keys // 128))]
+        self.active[:] = False
+
+        # MidiWriter only advances the time if the last frame was silent.
+        frame = self.frame - 1 if self.emitted else self.frame
+
+        events = numpy.zeros(len(keys), dtype=EVENT_DTYPE)
+        events["tick"] = self.tick_increment * (frame + 1)
+        events["type"] = NOTE_OFF
+        events["channel"] = self.channel_map[keys // 128]
+        events["pitch"] = keys % 128
+        return events
+
+
+def encode_events(events):
+    """
+    events is an EVENT_DTYPE array sorted by tick.
+
+    Encodes the events as MIDI track data, with variable length delta
+        times and running status. Note offs are encoded as zero
+        velocity note ons.
+    """
+
+    if not len(events):
+        return b""
+
+    ticks = events["tick"].astype(numpy.int64)
+    deltas = numpy.diff(ticks, prepend=0)
+    status = NOTE_ON | events["channel"].astype(numpy.int64)
+
+    lengths = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    has_status = numpy.ones(len(events), dtype=bool)
+    has_status[1:] = status[1:] != status[:-1]
+
+    sizes = lengths + has_status + 2
+    offsets = numpy.cumsum(sizes) - sizes
+    data = numpy.zeros(int(sizes.sum()), dtype=numpy.uint8)
+
+    for byte in range(4):
+        # The byte'th most significant 7 bit group of each delta.
+        mask = lengths > byte
+        shift = 7 * (lengths[mask] - 1 - byte)
+        groups = (deltas[mask] >> shift) & 0x7F
+        groups[shift > 0] |= 0x80
+        data[offsets[mask] + byte] = groups
+
+    offsets = offsets + lengths
+    data[offsets[has_status]] = status[has_status]
+    offsets = offsets + has_status
+    data[offsets] = events["pitch"]
+    data[offsets + 1] = events["velocity"]
+
+    return data.tobytes()
+
+
+def pair_notes(events):
+    """
+    events is an EVENT_DTYPE array in which every note on is followed by
+        a note off of the same channel and pitch, as written by
+        MemoryMidiWriter.
+
+    Returns a NOTE_DTYPE array with one entry per note on, in the order
+        of the note ons.
+    """
+
+    # Within each (channel, pitch) the events alternate between on and
+    # off, so the nth on of a key pairs with its nth off.
+    order = numpy.lexsort(
+        (numpy.arange(len(events)), events["pitch"], events["channel"])
+    )
+    ordered = events[order]
+    is_on = ordered["type"] == NOTE_ON
+    ons = ordered[is_on]
+    offs = ordered[~is_on]
+    if len(ons) != len(offs):
+        raise RuntimeError("Unterminated notes in events.")
+
+    notes = numpy.zeros(len(ons), dtype=NOTE_DTYPE)
+    for field in ["tick", "channel", "pitch", "velocity"]:
+        notes[field] = ons[field]
+    notes["duration"] = offs["tick"] - ons["tick"]
+
+    return notes[numpy.argsort(order[is_on], kind="stable")]
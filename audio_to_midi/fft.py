@@ -0,0 +1,119 @@
+from collections import OrderedDict
+
+import numpy
+
+from audio_to_midi import options
+
+# scipy and pyfftw are imported when a backend first uses them.
+BACKENDS = options.FFT_BACKENDS
+
+# pyfftw transforms batches in chunks of a power of two windows up to
+# this many, so a handful of plans covers batches of any size.
+PLAN_FRAMES = 64
+
+# The number of pyfftw plans kept, the least recently used first dropped.
+MAX_PLANS = 32
+
+
+def _import(name):
+    try:
+        if name == "scipy":
+            import scipy.fft
+
+            return scipy.fft
+        if name == "pyfftw":
+            import pyfftw.builders
+
+            return pyfftw.builders
+    except ImportError:
+        raise RuntimeError("The {} FFT backend isn't installed.".format(name))
+    return numpy.fft
+
+
+class Backend:
+    """
+    Computes the rfft of batches of time windows along axis 1 with one
+        of the BACKENDS, on workers threads where the backend supports
+        them. Single precision frames are transformed in single
+        precision, except by numpy before 2.0.
+
+    pyfftw plans are built for chunks of a power of two time windows,
+        at most PLAN_FRAMES, and reused for every batch with the same
+        window size, channels and dtype, whichever its length. The last
+        MAX_PLANS are kept with the backend, which is only used by one
+        conversion at a time. numpy and scipy cache their plans
+        themselves.
+    """
+
+    __slots__ = ["name", "workers", "module", "plans"]
+
+    def __init__(self, name="numpy", workers=1):
+        if name not in BACKENDS:
+            raise RuntimeError("Unknown FFT backend: {}".format(name))
+        if workers < 1:
+            raise RuntimeError("Invalid FFT worker count: {}".format(workers))
+
+        self.name = name
+        self.workers = workers
+        self.module = _import(name)
+        self.plans = OrderedDict()
+
+    def __getstate__(self):
+        # Plans and modules aren't picklable, worker processes rebuild them.
+        return self.name, self.workers
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "Backend({!r}, {!r})".format(self.name, self.workers)
+
+    def _plan(self, frames):
+        key = (frames.shape, frames.dtype.str)
+        if key in self.plans:
+            self.plans.move_to_end(key)
+        else:
+            self.plans[key] = self.module.rfft(
+                numpy.empty(frames.shape, frames.dtype),
+                axis=1,
+                threads=self.workers,
+                avoid_copy=False,
+            )
+            if len(self.plans) > MAX_PLANS:
+                self.plans.popitem(last=False)
+        return self.plans[key]
+
+    def _chunked_rfft(self, frames):
+        # Chunks of PLAN_FRAMES windows, then the binary digits of the
+        # remainder, so no chunk is padded.
+        chunks = []
+        start = 0
+        while start < len(frames):
+            size = min(PLAN_FRAMES, 1 << (len(frames) - start).bit_length() - 1)
+            chunks.append((start, start + size))
+            start += size
+
+        if len(chunks) == 1:
+            return self._plan(frames)(frames)
+
+        spectrum = None
+        for start, stop in chunks:
+            chunk = self._plan(frames[start:stop])(frames[start:stop])
+            if spectrum is None:
+                spectrum = numpy.empty((len(frames),) + chunk.shape[1:], chunk.dtype)
+            spectrum[start:stop] = chunk
+        return spectrum
+
+    def rfft(self, frames):
+        """
+        frames is a real array of shape (frames, block_size, channels).
+
+        Returns its rfft along axis 1. The result of the pyfftw backend
+            may be overwritten by the next call.
+        """
+
+        if self.name == "scipy":
+            return self.module.rfft(frames, axis=1, workers=self.workers)
+        if self.name == "pyfftw":
+            return self._chunked_rfft(frames)
+        return self.module.rfft(frames, axis=1)
@@ -0,0 +1,99 @@
+from functools import lru_cache
+
+import numpy
+
+from audio_to_midi import notes
+
+# The ratio of each band's centre frequency to its bandwidth, for bands
+# a semitone apart.
+Q = 1 / (numpy.float_power(2.0, 1.0 / 12) - 1)
+
+# Kernel spectrum values below this fraction of a band's peak are dropped,
+# as in Brown and Puckette's efficient constant Q transform.
+THRESHOLD = 0.0054
+
+# The number of filterbanks kept, each a matrix of up to a few MB.
+CACHE_SIZE = 8
+
+
+class Filterbank:
+    """
+    Maps the rfft of a time window to one constant Q band per midi pitch,
+        starting at pitch lowest. Kernel weights below the threshold are
+        zeroed and only the rows of the bins which some band uses are
+        kept, between first and first + len(matrix), so applying it is
+        one matrix product.
+    """
+
+    __slots__ = ["first", "matrix", "lowest"]
+
+    def __init__(self, first, matrix, lowest):
+        self.first = first
+        self.matrix = matrix
+        self.lowest = lowest
+
+    def __len__(self):
+        return self.matrix.shape[1]
+
+    def apply(self, spectrum):
+        """
+        spectrum is an rfft of shape (frames, bins, channels).
+
+        Returns the complex band values with the shape
+            (frames, bands, channels), scaled like rfft bins so a sine
+            wave at a band's centre has the same magnitude in both.
+        """
+
+        rows = spectrum[:, self.first : self.first + len(self.matrix)]
+        return numpy.matmul(rows.transpose(0, 2, 1), self.matrix).transpose(0, 2, 1)
+
+
+@lru_cache(CACHE_SIZE)
+def semitone(samplerate, block_size, window=None, dtype=complex):
+    """
+    window is a window function such as numpy.hanning, or None for
+        rectangular kernels.
+    dtype is the complex dtype of the matrix.
+
+    Builds the Filterbank for time windows of block_size samples. Each
+        band is a complex sinusoid at the centre frequency of a midi
+        pitch, Q periods long and centred in the window. Only the
+        pitches whose kernel fits in the window are a semitone wide, so
+        the bands start at the lowest of them and stop below the Nyquist
+        frequency. Returns None when no pitch fits.
+    """
+
+    centres = notes.table()[:, 1]
+    lengths = numpy.ceil(Q * samplerate / centres).astype(int)
+    pitches = numpy.flatnonzero((lengths <= block_size) & (centres < samplerate / 2))
+    if not len(pitches):
+        return None
+
+    bins = numpy.arange(block_size // 2 + 1)
+    matrix = numpy.zeros((len(bins), len(pitches)), dtype=complex)
+    for band, pitch in enumerate(pitches):
+        centre = centres[pitch]
+        length = lengths[pitch]
+        taper = window(length) if window else numpy.ones(length)
+
+        kernel = numpy.zeros(block_size, dtype=complex)
+        offset = (block_size - length) // 2
+        kernel[offset : offset + length] = (
+            taper
+            / taper.sum()
+            * numpy.exp(-2j * numpy.pi * centre * numpy.arange(length) / samplerate)
+        )
+
+        # Summing x * kernel over the window is the same as summing the
+        # spectrum of x with the kernel's spectrum at the negated bins,
+        # which is concentrated around the band's positive frequency.
+        response = numpy.fft.fft(kernel)[-bins % block_size]
+        magnitudes = numpy.abs(response)
+        response[magnitudes < THRESHOLD * magnitudes.max()] = 0
+        matrix[:, band] = response
+
+    used = numpy.flatnonzero(matrix.any(axis=1))
+    matrix = matrix[used[0] : used[-1] + 1].astype(dtype)
+    matrix.setflags(write=False)
+
+    return Filterbank(int(used[0]), matrix, int(pitches[0]))
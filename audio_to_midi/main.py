@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
 import argparse
+import glob
 import os
 import sys
 import logging
 
-from audio_to_midi import converter, progress_bar
+# Only the modules the argument parser needs are imported up front. The
+# analysis modules pull in numpy, soundfile and the midi and progress bar
+# libraries, so they're imported on the paths which use them, keeping
+# --help and argument errors fast.
+from audio_to_midi import options, profiling
 
 
 def _convert_beat_to_time(bpm, beat):
@@ -23,12 +28,69 @@ def _convert_beat_to_time(bpm, beat):
         raise RuntimeError("Invalid beat format: {}".format(beat))
 
 
-def parse_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("infile", help="The sound file to process.")
+def parse_args(argv=None, parser_class=argparse.ArgumentParser):
+    parser = parser_class(
+        epilog="Run 'audio-to-midi serve --help' for the conversion daemon, and 'audio-to-midi sweep --help' to convert with a grid of note selection options."
+    )
+    parser.add_argument(
+        "infile",
+        nargs="*",
+        help="The sound file to process. Several files, directories or glob patterns convert each file in batch mode. - streams from stdin.",
+    )
     parser.add_argument(
         "--output", "-o", help="The MIDI file to output. Default: <infile>.mid"
     )
+    parser.add_argument(
+        "--output-dir",
+        help="Batch mode: the directory to write MIDI files to. Default: next to each input",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Batch mode: a file listing one input per line.",
+    )
+    parser.add_argument(
+        "--skip-up-to-date",
+        choices=["mtime", "hash"],
+        help="Batch mode: skip inputs whose MIDI file is newer than the input, or was converted from identical content and options.",
+    )
+    parser.add_argument(
+        "--samplerate",
+        type=int,
+        help="Streaming: read stdin as raw PCM at this sample rate rather than WAV.",
+    )
+    parser.add_argument(
+        "--channels",
+        type=int,
+        default=1,
+        help="Streaming: the channel count of raw PCM input. Default: 1",
+    )
+    parser.add_argument(
+        "--subtype",
+        default="PCM_16",
+        help="Streaming: the sample format of raw PCM input. Default: PCM_16",
+    )
+    parser.add_argument(
+        "--select-channels",
+        type=int,
+        nargs="+",
+        help="Only analyse these input channels, counted from 0. Their notes keep the MIDI channel of the input channel. Ex: --select-channels 0 2",
+    )
+    parser.add_argument(
+        "--mix",
+        choices=options.MIXES,
+        help="Mix the (selected) input channels before the analysis: mono averages them onto MIDI channel 0, mid-side turns two channels into their mid and side signals on MIDI channels 0 and 1.",
+    )
+    parser.add_argument(
+        "--duplicate-tolerance",
+        type=float,
+        default=0.0,
+        help="Channels whose samples differ by no more than this in a batch of time windows are analysed once and their notes copied. Default: 0, only identical channels",
+    )
+    parser.add_argument(
+        "--no-dedupe",
+        action="store_true",
+        help="Analyse every channel, even when it duplicates another one.",
+    )
     parser.add_argument(
         "--time-window",
         "-t",
@@ -36,6 +98,50 @@ def parse_args():
         type=float,
         help="The time span over which to compute the individual FFTs in milliseconds.",
     )
+    parser.add_argument(
+        "--hop",
+        type=float,
+        help="The time between the starts of successive FFT windows in milliseconds. Shorter than the time window, windows overlap. Default: the time window",
+    )
+    parser.add_argument(
+        "--window",
+        default="rectangular",
+        choices=list(options.WINDOWS),
+        help="The window function applied before each FFT. Default: rectangular",
+    )
+    parser.add_argument(
+        "--engine",
+        default="fft",
+        choices=options.ENGINES,
+        help="The analysis engine. fft reduces linear FFT bins to pitches, filterbank computes one constant Q band a semitone wide per MIDI pitch, from about 17000 / time window Hz. Default: fft",
+    )
+    parser.add_argument(
+        "--fft-backend",
+        default="numpy",
+        choices=options.FFT_BACKENDS,
+        help="The library which computes the FFT. scipy and pyfftw have to be installed separately. Default: numpy",
+    )
+    parser.add_argument(
+        "--fft-workers",
+        type=int,
+        default=1,
+        help="The number of threads each FFT uses, with the scipy and pyfftw backends. Default: 1",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Analyse in single precision, which halves the memory traffic of the analysis. Velocities may differ by one step from double precision.",
+    )
+    parser.add_argument(
+        "--no-gate",
+        action="store_true",
+        help="Run the FFT on every time window, instead of skipping the windows which are too quiet to clear the activation level. The output is the same either way.",
+    )
+    parser.add_argument(
+        "--analysis-rate",
+        type=int,
+        help="Decimate inputs above this sample rate by the largest integer factor which keeps them at or above it before the FFT, e.g. 48000.",
+    )
     parser.add_argument(
         "--activation-level",
         "-a",
@@ -105,17 +211,84 @@ def parse_args():
         type=int,
         help="The minimum and maximum allowed MIDI notes. These may be superseded by the calculated FFT range.",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=512,
+        help="The number of time windows to analyse per FFT call. 0 analyses one window at a time. Default: 512",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of worker processes to analyse the input with. In batch mode, the number of files converted at once. Default: 1",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="A directory to cache the spectrum of each input in, so later runs with the same input, time window and sample rate skip decoding and the FFT.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        help="The size in MB beyond which the least recently used cache entries are evicted. Default: 1024",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        help="Save a checkpoint of the conversion next to the output every CHECKPOINT_INTERVAL seconds, so --resume can continue it after an interruption. Default with --resume: 60",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the conversion from its last checkpoint, if there is one, and keep saving checkpoints. The output is the same as an uninterrupted conversion's.",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="table",
+        choices=profiling.FORMATS,
+        help="Print the time spent in each conversion stage as a table, JSON or Prometheus metrics. Default: table",
+    )
+    parser.add_argument(
+        "--profile-output",
+        help="The file to write the --profile report to. Default: stdout",
+    )
     parser.add_argument(
         "--no-progress", "-n", action="store_true", help="Don't print the progress bar."
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    args.output = (
-        "{}.mid".format(os.path.basename(args.infile))
-        if not args.output
-        else args.output
+    if not args.infile and not args.manifest:
+        parser.error("the following arguments are required: infile")
+
+    args.batch = bool(
+        len(args.infile) != 1
+        or args.manifest
+        or args.output_dir
+        or args.skip_up_to_date
+        or os.path.isdir(args.infile[0])
+        or (glob.has_magic(args.infile[0]) and not os.path.exists(args.infile[0]))
     )
 
+    if args.batch:
+        if args.output:
+            raise RuntimeError("--output can't be used in batch mode, use --output-dir")
+        if args.profile:
+            raise RuntimeError("--profile can't be used in batch mode")
+        if args.checkpoint_interval or args.resume:
+            raise RuntimeError("Checkpoints can't be used in batch mode")
+    else:
+        args.infile = args.infile[0]
+        args.output = (
+            "{}.mid".format(
+                "stdin" if args.infile == "-" else os.path.basename(args.infile)
+            )
+            if not args.output
+            else args.output
+        )
+
     if args.single_note:
         args.note_count = 1
 
@@ -128,6 +301,9 @@ def parse_args():
         args.time_window = _convert_beat_to_time(args.bpm, args.beat)
         print(args.time_window)
 
+    if args.hop is not None and not 0 < args.hop <= args.time_window:
+        raise RuntimeError("Invalid hop: {}".format(args.hop))
+
     if args.pitch_range:
         if args.pitch_range[0] > args.pitch_range[1]:
             raise RuntimeError("Invalid pitch range: {}".format(args.pitch_range))
@@ -135,31 +311,403 @@ def parse_args():
     if args.condense_max:
         args.condense = True
 
+    if args.batch_size < 0:
+        raise RuntimeError("Invalid batch size: {}".format(args.batch_size))
+
+    if args.jobs < 1:
+        raise RuntimeError("Invalid job count: {}".format(args.jobs))
+
+    if args.duplicate_tolerance < 0:
+        raise RuntimeError(
+            "Invalid duplicate tolerance: {}".format(args.duplicate_tolerance)
+        )
+
+    if args.fft_workers < 1:
+        raise RuntimeError("Invalid FFT worker count: {}".format(args.fft_workers))
+
+    if args.checkpoint_interval is not None and args.checkpoint_interval <= 0:
+        raise RuntimeError(
+            "Invalid checkpoint interval: {}".format(args.checkpoint_interval)
+        )
+
+    if args.cache_size < 0:
+        raise RuntimeError("Invalid cache size: {}".format(args.cache_size))
+
     return args
 
 
+def parse_serve_args(argv=None):
+    from audio_to_midi import serve
+
+    parser = argparse.ArgumentParser(
+        prog="audio-to-midi serve",
+        description="Serve conversion jobs over HTTP from a pool of worker processes. Jobs take the same options as a single file conversion.",
+    )
+    parser.add_argument(
+        "--socket", help="Listen on this Unix socket instead of on --host and --port."
+    )
+    parser.add_argument(
+        "--host",
+        default=serve.DEFAULT_HOST,
+        help="The address to listen on. Default: {}".format(serve.DEFAULT_HOST),
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=serve.DEFAULT_PORT,
+        help="The port to listen on. Default: {}".format(serve.DEFAULT_PORT),
+    )
+    parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        help="The number of worker processes. Default: the number of CPUs",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        help="The number of jobs which can be queued or running before new ones are rejected. Default: 4 * workers",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=serve.DEFAULT_HISTORY,
+        help="The number of finished jobs to keep results for. Default: {}".format(
+            serve.DEFAULT_HISTORY
+        ),
+    )
+    parser.add_argument(
+        "--root",
+        help="The directory which the input, output and --cache-dir paths of jobs must be inside. Without it, jobs can only give paths over --socket.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.workers is not None and args.workers < 1:
+        raise RuntimeError("Invalid worker count: {}".format(args.workers))
+    if args.queue_size is not None and args.queue_size < 1:
+        raise RuntimeError("Invalid queue size: {}".format(args.queue_size))
+    if args.root and not os.path.isdir(args.root):
+        raise RuntimeError("No such directory: {}".format(args.root))
+
+    return args
+
+
+# The values of the sweep's --condense option, as the Converter's condense
+# and condense_max.
+CONDENSE_MODES = {"off": (False, False), "on": (True, False), "max": (True, True)}
+
+
+def _parse_pitch_set(value):
+    if value == "all":
+        return []
+    try:
+        pitch_set = [int(key) for key in value.split(",")]
+    except ValueError:
+        raise RuntimeError("Invalid pitch set: {}".format(value))
+    for key in pitch_set:
+        if key not in range(12):
+            raise RuntimeError("Key values must be in the range: [0, 12)")
+    return pitch_set
+
+
+def parse_sweep_args(argv=None):
+    """
+    Returns the sweep's arguments, and the arguments of a single file
+        conversion parsed from the options which aren't swept.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="audio-to-midi sweep",
+        usage="%(prog)s infile [options] [conversion options]",
+        description="Convert a sound file with every combination of the given values, decoding it and computing the FFT once per time window. Any option of a single file conversion which isn't swept applies to every combination.",
+    )
+    parser.add_argument("infile", help="The sound file to process.")
+    parser.add_argument(
+        "--output-dir",
+        "-o",
+        help="The directory to write one MIDI file per combination to, named after the input and the swept values. Default: next to the input",
+    )
+    parser.add_argument(
+        "--time-window",
+        "-t",
+        type=float,
+        nargs="+",
+        help="The time windows in milliseconds.",
+    )
+    parser.add_argument(
+        "--activation-level",
+        "-a",
+        type=float,
+        nargs="+",
+        help="The activation levels, between 0 and 1.",
+    )
+    parser.add_argument(
+        "--note-count",
+        "-C",
+        type=int,
+        nargs="+",
+        help="The numbers of loudest notes to keep per time window, 0 for all.",
+    )
+    parser.add_argument(
+        "--pitch-set",
+        "-p",
+        nargs="+",
+        help="The pitch sets, as comma separated pitch classes or all. Ex: -p all 0,2,4,5,7,9,11",
+    )
+    parser.add_argument(
+        "--transpose",
+        "-T",
+        type=int,
+        nargs="+",
+        help="The transpositions.",
+    )
+    parser.add_argument(
+        "--condense",
+        "-c",
+        nargs="+",
+        choices=list(CONDENSE_MODES),
+        help="Whether to condense contiguous notes at their average (on) or maximum (max) velocity.",
+    )
+    args, rest = parser.parse_known_args(argv)
+
+    conversion = parse_args([args.infile] + rest)
+    if conversion.batch:
+        raise RuntimeError("A sweep converts a single input")
+    if args.infile == "-":
+        raise RuntimeError("Streams can't be swept")
+    if conversion.checkpoint_interval or conversion.resume:
+        raise RuntimeError("Sweeps can't be checkpointed")
+
+    for time_window in args.time_window or []:
+        if time_window <= 0:
+            raise RuntimeError("Invalid time window: {}".format(time_window))
+        if conversion.hop is not None and conversion.hop > time_window:
+            raise RuntimeError("Invalid hop: {}".format(conversion.hop))
+    args.pitch_set = [_parse_pitch_set(value) for value in args.pitch_set or []]
+
+    return args, conversion
+
+
+def _sweep_grid(args, conversion):
+    """
+    Returns the swept values of each combination, named after the
+        sweep's options, and the Converter options they stand for.
+    """
+
+    from audio_to_midi import sweep
+
+    condense = (
+        "max" if conversion.condense_max else "on" if conversion.condense else "off"
+    )
+    values = {
+        "time_window": args.time_window or [conversion.time_window],
+        "activation_level": args.activation_level or [conversion.activation_level],
+        "note_count": args.note_count or [conversion.note_count],
+        "pitch_set": args.pitch_set or [conversion.pitch_set],
+        "transpose": args.transpose or [conversion.transpose],
+        "condense": args.condense or [condense],
+    }
+    swept = [name for name, value in values.items() if len(value) > 1]
+
+    combinations = []
+    for combination in sweep.grid(**values):
+        labels = {name: combination[name] for name in swept}
+        config = dict(combination)
+        config["condense"], config["condense_max"] = CONDENSE_MODES[
+            combination["condense"]
+        ]
+        combinations.append((labels, config))
+    return combinations
+
+
+class _JobArgumentParser(argparse.ArgumentParser):
+    # Invalid job options are reported to the client rather than ending
+    # the daemon.
+    def error(self, message):
+        raise RuntimeError(message)
+
+
+def _job_options(name, argv):
+    """
+    Parses the command line arguments of a daemon job for the input
+        name and returns its Converter options.
+    """
+
+    args = parse_args([name] + argv, _JobArgumentParser)
+    if args.batch or name == "-":
+        raise RuntimeError("Jobs convert a single input")
+    if args.checkpoint_interval or args.resume:
+        raise RuntimeError("Jobs can't be checkpointed")
+    return _converter_options(args)
+
+
+def _converter_options(args):
+    from audio_to_midi import cache
+
+    return {
+        "time_window": args.time_window,
+        "hop": args.hop,
+        "window": args.window,
+        "engine": args.engine,
+        "analysis_rate": args.analysis_rate,
+        "fft_backend": args.fft_backend,
+        "fft_workers": args.fft_workers,
+        "float32": args.float32,
+        "gate": not args.no_gate,
+        "select_channels": args.select_channels,
+        "mix": args.mix,
+        "dedupe": not args.no_dedupe,
+        "duplicate_tolerance": args.duplicate_tolerance,
+        "activation_level": args.activation_level,
+        "condense": args.condense,
+        "condense_max": args.condense_max,
+        "max_note_length": args.max_note_length,
+        "note_count": args.note_count,
+        "transpose": args.transpose,
+        "pitch_set": args.pitch_set,
+        "pitch_range": args.pitch_range,
+        "bpm": args.bpm,
+        "batch_size": args.batch_size,
+        "cache": (
+            cache.SpectralCache(args.cache_dir, args.cache_size << 20)
+            if args.cache_dir
+            else None
+        ),
+    }
+
+
+def _write_profile(args, profiler):
+    report = profiler.report(args.profile)
+    if args.profile_output:
+        with open(args.profile_output, "w") as outfile:
+            outfile.write(report + "\n")
+    else:
+        print(report)
+
+
 def main():
     try:
         logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 
+        if sys.argv[1:2] == ["serve"]:
+            from audio_to_midi import serve
+
+            args = parse_serve_args(sys.argv[2:])
+            serve.serve(
+                _job_options,
+                socket=args.socket,
+                host=args.host,
+                port=args.port,
+                workers=args.workers,
+                queue_size=args.queue_size,
+                history=args.history,
+                root=args.root,
+            )
+            return
+
+        if sys.argv[1:2] == ["sweep"]:
+            from audio_to_midi import sweep
+
+            args, conversion = parse_sweep_args(sys.argv[2:])
+            configs = []
+            for labels, config in _sweep_grid(args, conversion):
+                config["outfile"] = sweep.output_path(
+                    args.infile, labels, args.output_dir
+                )
+                configs.append(config)
+
+            progress = None
+            if not conversion.no_progress:
+                from audio_to_midi import progress_bar
+
+                progress = progress_bar.ProgressBar()
+
+            if args.output_dir:
+                os.makedirs(args.output_dir, exist_ok=True)
+            sweep.convert_sweep(
+                args.infile, configs, progress, **_converter_options(conversion)
+            )
+            for config in configs:
+                logging.info("wrote {}".format(config["outfile"]))
+            return
+
         args = parse_args()
 
+        if args.batch:
+            from audio_to_midi import batch
+
+            results = batch.convert_files(
+                batch.expand_inputs(args.infile, args.manifest),
+                _converter_options(args),
+                output_dir=args.output_dir,
+                skip=args.skip_up_to_date,
+                jobs=args.jobs,
+            )
+            if any(result.error for result in results):
+                sys.exit(1)
+            return
+
+        profiler = profiling.Profiler() if args.profile else None
+
+        if args.infile == "-":
+            from audio_to_midi import stream
+
+            if args.checkpoint_interval or args.resume:
+                raise RuntimeError("Streams can't be checkpointed")
+
+            process = stream.convert_stream(
+                sys.stdin.fileno(),
+                outfile=args.output,
+                samplerate=args.samplerate,
+                channels=args.channels,
+                subtype=args.subtype,
+                profiler=profiler,
+                **_converter_options(args)
+            )
+            logging.info(
+                "latency: mean = {:.3f} ms, max = {:.3f} ms over {} windows".format(
+                    process.mean_latency * 1000,
+                    process.max_latency * 1000,
+                    process.windows,
+                )
+            )
+            if profiler:
+                _write_profile(args, profiler)
+            return
+
+        from audio_to_midi import converter
+
+        progress = None
+        if not args.no_progress:
+            from audio_to_midi import progress_bar
+
+            # Each step of the progress is one hop of audio.
+            progress = progress_bar.ProgressBar(
+                scale=(args.hop or args.time_window) / 1000, unit="audio-s"
+            )
+
+        checkpoint = None
+        if args.checkpoint_interval or args.resume:
+            from audio_to_midi.checkpoint import DEFAULT_INTERVAL, Checkpoint
+
+            checkpoint = Checkpoint(
+                args.output + ".ckpt",
+                args.checkpoint_interval or DEFAULT_INTERVAL,
+                resume=args.resume,
+            )
+
         process = converter.Converter(
             infile=args.infile,
             outfile=args.output,
-            time_window=args.time_window,
-            activation_level=args.activation_level,
-            condense=args.condense,
-            condense_max=args.condense_max,
-            max_note_length=args.max_note_length,
-            note_count=args.note_count,
-            transpose=args.transpose,
-            pitch_set=args.pitch_set,
-            pitch_range=args.pitch_range,
-            progress=None if args.no_progress else progress_bar.ProgressBar(),
-            bpm=args.bpm,
+            progress=progress,
+            jobs=args.jobs,
+            profiler=profiler,
+            checkpoint=checkpoint,
+            **_converter_options(args)
         )
         process.convert()
+        if profiler:
+            _write_profile(args, profiler)
     except KeyboardInterrupt:
         sys.exit(1)
     except Exception as e:
@@ -1,15 +1,33 @@
 from collections import defaultdict
+from struct import pack
 
-import python3_midi as midi
+import numpy
+
+from audio_to_midi.events import (
+    EVENT_DTYPE,
+    NOTE_OFF,
+    NOTE_ON,
+    EventCompiler,
+    encode_events,
+)
+
+
+def _midi():
+    # python3_midi is only needed when events are streamed through it,
+    # so it's imported on first use rather than with this module.
+    import python3_midi
+
+    return python3_midi
 
 
 class NoteState:
-    __slots__ = ["is_active", "event_pos", "count"]
+    __slots__ = ["is_active", "event_pos", "count", "total"]
 
-    def __init__(self, is_active=False, event_pos=None, count=0):
+    def __init__(self, is_active=False, event_pos=None, count=0, total=0):
         self.is_active = is_active
         self.event_pos = event_pos
         self.count = count
+        self.total = total
 
 
 class MidiWriter:
@@ -22,12 +40,17 @@ class MidiWriter:
         condense=False,
         condense_max=False,
         max_note_length=0,
+        stream=None,
+        channel_map=None,
     ):
         self.outfile = outfile
+        self.stream = stream
         self.condense = condense
         self.condense_max = condense_max
         self.max_note_length = max_note_length
         self.channels = channels
+        # The midi channel the notes of each channel are written to.
+        self.channel_map = list(range(channels) if channel_map is None else channel_map)
         self.time_window = time_window
         self.bpm = bpm
         self.note_state = [defaultdict(lambda: NoteState()) for _ in range(channels)]
@@ -39,7 +62,7 @@ class MidiWriter:
         self._need_increment = False
 
     def __enter__(self):
-        self.stream = midi.FileStream(self.outfile)
+        self.stream = self.stream or _midi().FileStream(self.outfile)
         self.stream.start_pattern(
             format=1,
             tick_relative=False,
@@ -48,7 +71,7 @@ class MidiWriter:
         )
         self.stream.start_track(
             events=[
-                midi.TimeSignatureEvent(
+                _midi().TimeSignatureEvent(
                     tick=0,
                     numerator=1,
                     denominator=4,
@@ -62,11 +85,21 @@ class MidiWriter:
 
     def __exit__(self, type, value, traceback):
         self._terminate_notes()
-        self.stream.add_event(midi.EndOfTrackEvent(tick=1))
+        self.stream.add_event(_midi().EndOfTrackEvent(tick=1))
         self.stream.end_track()
         self.stream.end_pattern()
         self.stream.close()
 
+    def flush(self):
+        """
+        Flushes the events written so far to the output file so it can
+            be read while it grows.
+        """
+
+        midifile = getattr(self.stream, "midifile", None)
+        if midifile:
+            midifile.flush()
+
     def _skip(self):
         self.skip_count += 1
 
@@ -82,27 +115,46 @@ class MidiWriter:
             self._reset_skip()
         return ret
 
-    def _note_on(self, channel, pitch, velocity):
-        pos = self.stream.add_event(
-            midi.NoteOnEvent(
-                tick=self.tick, channel=channel, pitch=pitch, velocity=velocity
+    def _add_event(self, type, channel, pitch, velocity):
+        # Note offs are written as zero velocity note ons so every event
+        # shares the running status of its channel.
+        return self.stream.add_event(
+            _midi().NoteOnEvent(
+                tick=self.tick,
+                channel=self.channel_map[channel],
+                pitch=pitch,
+                velocity=velocity,
             )
         )
-        self.note_state[channel][pitch] = NoteState(
-            True,
-            pos,
-            1,
-        )
+
+    def _get_velocity(self, pos):
+        return self.stream.get_event(_midi().NoteOnEvent, pos).data[1]
+
+    def _set_velocity(self, pos, velocity):
+        # FileStream.set_event re-encodes the event against the current
+        # running status, which can change its length, so only the
+        # velocity byte is patched. Streams without a file can't be
+        # rewritten.
+        midifile = getattr(self.stream, "midifile", None)
+        if not midifile:
+            return
+
+        end_pos = midifile.tell()
+        midifile.seek(pos)
+        while midifile.read(1)[0] & 0x80:
+            pass
+        if midifile.read(1)[0] & 0x80:
+            midifile.read(1)
+        midifile.write(bytes([velocity]))
+        midifile.seek(end_pos)
+
+    def _note_on(self, channel, pitch, velocity):
+        pos = self._add_event(NOTE_ON, channel, pitch, velocity)
+        self.note_state[channel][pitch] = NoteState(True, pos, 1, velocity)
 
     def _note_off(self, channel, pitch):
         self.note_state[channel][pitch] = NoteState()
-        self.stream.add_event(
-            midi.NoteOffEvent(
-                tick=self.tick,
-                channel=channel,
-                pitch=pitch,
-            )
-        )
+        self._add_event(NOTE_OFF, channel, pitch, 0)
 
     def add_notes(self, notes):
         """
@@ -125,21 +177,15 @@ class MidiWriter:
                 if (not self.condense) or (self.condense and not note_state.is_active):
                     self._note_on(channel, note.pitch, note.velocity)
                 elif self.condense and note_state.is_active:
-                    event = self.stream.get_event(
-                        midi.NoteOnEvent, note_state.event_pos
-                    )
-                    old_velocity = event.data[1]
+                    old_velocity = self._get_velocity(note_state.event_pos)
+                    note_state.count += 1
+                    note_state.total += note.velocity
                     if self.condense_max:
                         new_velocity = max(note.velocity, old_velocity)
                     else:
-                        count = note_state.count
-                        note_state.count += 1
-                        new_velocity = ((old_velocity * count) + note.velocity) // (
-                            note_state.count
-                        )
-                    if old_velocity != event.data[1]:
-                        event.data[1] = new_velocity
-                        self.stream.set_event(event, note_state.event_pos)
+                        new_velocity = note_state.total // note_state.count
+                    if new_velocity != old_velocity:
+                        self._set_velocity(note_state.event_pos, new_velocity)
 
             if self.condense:
                 active_notes = [
@@ -165,3 +211,109 @@ class MidiWriter:
             for note, note_state in self.note_state[channel].items():
                 if note_state.is_active:
                     self._note_off(channel, note)
+
+
+class MemoryMidiWriter(MidiWriter):
+    """
+    A MidiWriter which keeps its events in a compact EVENT_DTYPE array,
+        updates condensed velocities in place and serializes the track
+        in a single write when it exits. The file is byte for byte the
+        same as the one MidiWriter streams out. Without an outfile the
+        events are only kept in memory.
+
+    Whole velocity arrays can be added with add_frames(), which must
+        not be mixed with add_notes() on the same writer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events = numpy.zeros(1 << 12, dtype=EVENT_DTYPE)
+        self.size = 0
+        self.time = 0
+        self.compiler = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._terminate_notes()
+        if self.compiler:
+            self.add_events(self.compiler.finish())
+        if type is None and self.outfile:
+            with open(self.outfile, "wb") as outfile:
+                outfile.write(self.to_bytes())
+
+    def _add_event(self, type, channel, pitch, velocity):
+        if self.size == len(self.events):
+            self.events = numpy.resize(self.events, 2 * len(self.events))
+
+        self.time += self.tick
+        self.events[self.size] = (
+            self.time,
+            type,
+            self.channel_map[channel],
+            pitch,
+            velocity,
+        )
+        self.size += 1
+        return self.size - 1
+
+    def add_events(self, events):
+        """
+        events is an EVENT_DTYPE array which follows the events already
+            written.
+        """
+
+        if self.size + len(events) > len(self.events):
+            capacity = max(2 * len(self.events), self.size + len(events))
+            self.events = numpy.resize(self.events, capacity)
+
+        self.events[self.size : self.size + len(events)] = events
+        self.size += len(events)
+
+    def add_frames(self, velocities, by_velocity=False):
+        """
+        velocities is an array of shape (frames, 128, channels) where 0
+            means a note isn't present.
+        by_velocity orders the notes of a frame loudest first, as the
+            note lists of a note_count limited conversion are.
+
+        Compiles the notes of every frame at once with an EventCompiler.
+        """
+
+        if not self.compiler:
+            self.compiler = self.create_compiler(by_velocity)
+
+        events, positions, velocities = self.compiler.compile(velocities, self.size)
+        self.add_events(events)
+        self.events["velocity"][positions] = velocities
+
+    def create_compiler(self, by_velocity=False):
+        """
+        Returns an EventCompiler for the frames of this writer.
+        """
+
+        return EventCompiler(
+            self.channels,
+            self.tick_increment,
+            condense=self.condense,
+            condense_max=self.condense_max,
+            max_note_length=self.max_note_length,
+            by_velocity=by_velocity,
+            channel_map=self.channel_map,
+        )
+
+    def _get_velocity(self, pos):
+        return int(self.events["velocity"][pos])
+
+    def _set_velocity(self, pos, velocity):
+        self.events["velocity"][pos] = velocity
+
+    def to_bytes(self):
+        """
+        Serializes the events written so far to a standard MIDI file.
+        """
+
+        track = encode_events(self.events[: self.size]) + b"\x01\xff\x2f\x00"
+        header = b"MThd" + pack(">LHHH", 6, 1, 1, self.ms_per_beat)
+        return header + b"MTrk" + pack(">L", len(track)) + track
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import numpy
 
 def generate():
@@ -20,3 +22,37 @@ def generate():
         notes.update({i: [low, mid, high]})
 
     return notes
+
+
+@lru_cache(None)
+def table():
+    """
+    Returns the frequency ranges of generate() as a read only array of
+        shape (128, 3), holding the low, mid and high frequency of each
+        midi note. The high frequencies are sorted, so they can be used
+        as band edges with numpy.searchsorted.
+    """
+
+    notes = generate()
+    ranges = numpy.array([notes[pitch] for pitch in range(128)])
+    ranges.setflags(write=False)
+    return ranges
+
+
+def freqs_to_pitches(freqs):
+    """
+    freqs is an array of frequencies in Hz.
+
+    Returns the midi note whose frequency range contains each frequency,
+        the lowest one where two ranges share an edge.
+    """
+
+    ranges = table()
+    freqs = numpy.asarray(freqs, dtype=float)
+    pitches = numpy.searchsorted(ranges[:, 2], freqs)
+
+    unmappable = (pitches > 127) | (freqs < ranges[numpy.minimum(pitches, 127), 0])
+    if unmappable.any():
+        raise RuntimeError("Unmappable frequency: {}".format(freqs[unmappable][0]))
+
+    return pitches
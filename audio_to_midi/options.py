@@ -0,0 +1,25 @@
+# The names accepted by the Converter's window and engine options. They're
+# kept apart from the analysis modules so the command line can offer them
+# as choices without importing numpy.
+
+# The window functions which can be applied to each time window before
+# the fft, as the names of the numpy functions which compute them.
+# Rectangular leaves the samples as they are.
+WINDOWS = {
+    "rectangular": None,
+    "hann": "hanning",
+    "hamming": "hamming",
+    "blackman": "blackman",
+    "bartlett": "bartlett",
+}
+
+# The analysis engines. fft analyses the linear rfft bins, filterbank one
+# constant Q band per midi pitch computed from the rfft.
+ENGINES = ["fft", "filterbank"]
+
+# The libraries which can compute the fft. scipy and pyfftw are optional.
+FFT_BACKENDS = ["numpy", "scipy", "pyfftw"]
+
+# The mixes which can replace the input channels before the analysis. mono
+# averages them, mid-side turns a pair into their mid and side signals.
+MIXES = ["mono", "mid-side"]
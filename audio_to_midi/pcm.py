@@ -0,0 +1,109 @@
+import struct
+
+import numpy
+
+# The sample formats which can be read straight from the file, as their
+# numpy dtype, the value subtracted before scaling and the scale which
+# normalizes them to [-1, 1) the same way soundfile does.
+SUBTYPES = {
+    "PCM_U8": ("u1", 128, 1 / 0x80),
+    "PCM_16": ("<i2", 0, 1 / 0x8000),
+    "PCM_32": ("<i4", 0, 1 / 0x80000000),
+    "FLOAT": ("<f4", 0, 1),
+    "DOUBLE": ("<f8", 0, 1),
+}
+
+# The number of sample frames mapped at once. Only one segment is mapped
+# at a time, so memory use doesn't grow with the length of the file.
+SEGMENT_FRAMES = 1 << 18
+
+
+class Layout:
+    __slots__ = ["path", "offset", "dtype", "bias", "scale", "channels", "frames"]
+
+    def __init__(self, path, offset, dtype, bias, scale, channels, frames):
+        self.path = path
+        self.offset = offset
+        self.dtype = numpy.dtype(dtype)
+        self.bias = bias
+        self.scale = scale
+        self.channels = channels
+        self.frames = frames
+
+
+def _find_data_chunk(stream):
+    header = stream.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WAVE":
+        return None
+
+    while True:
+        chunk = stream.read(8)
+        if len(chunk) < 8:
+            return None
+        name, size = struct.unpack("<4sI", chunk)
+        if name == b"data":
+            return stream.tell()
+        # Chunks are padded to an even size.
+        stream.seek(size + (size & 1), 1)
+
+
+def layout(path, info):
+    """
+    path is a sound file and info its soundfile.info() or the open
+        soundfile.SoundFile.
+
+    Returns the Layout of the sample data when the file is uncompressed
+        PCM in a WAV container, so its samples can be memory mapped, or
+        None when it has to be decoded by soundfile.
+    """
+
+    if info.format not in ("WAV", "WAVEX") or info.subtype not in SUBTYPES:
+        return None
+    if info.endian not in ("FILE", "LITTLE"):
+        return None
+
+    try:
+        with open(path, "rb") as stream:
+            offset = _find_data_chunk(stream)
+    except OSError:
+        return None
+    if offset is None:
+        return None
+
+    return Layout(path, offset, *SUBTYPES[info.subtype], info.channels, info.frames)
+
+
+def blocks(layout, out, start=0, stop=None):
+    """
+    out is a float array of shape (frames, channels).
+
+    Like soundfile.blocks(out=out, fill_value=0), reads the sample frames
+        [start, stop) one block of len(out) frames at a time into out,
+        padding the last block with zeros. The samples are converted
+        straight from a memory map of the file, one segment at a time.
+    """
+
+    stop = layout.frames if stop is None else min(stop, layout.frames)
+    size = len(out)
+    segment_size = max(size, SEGMENT_FRAMES // size * size)
+    frame_bytes = layout.dtype.itemsize * layout.channels
+
+    for segment in range(start, stop, segment_size):
+        samples = numpy.memmap(
+            layout.path,
+            dtype=layout.dtype,
+            mode="r",
+            offset=layout.offset + segment * frame_bytes,
+            shape=(min(segment_size, stop - segment), layout.channels),
+        )
+        for pos in range(0, len(samples), size):
+            block = samples[pos : pos + size]
+            count = len(block)
+            if layout.bias:
+                numpy.subtract(block, layout.bias, out=out[:count], dtype=out.dtype)
+                out[:count] *= layout.scale
+            else:
+                numpy.multiply(block, layout.scale, out=out[:count], dtype=out.dtype)
+            out[count:] = 0
+            yield out
+        del samples
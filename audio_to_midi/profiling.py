@@ -0,0 +1,227 @@
+import json
+import time
+
+from functools import wraps
+
+FORMATS = ["table", "json", "prometheus"]
+
+# The order in which stages are reported. The total is the whole
+# conversion, which every other stage is part of.
+STAGES = [
+    "decode",
+    "dedupe",
+    "gate",
+    "fft",
+    "reduce",
+    "select",
+    "write",
+    "checkpoint",
+    "serialize",
+    "total",
+]
+
+
+class Stage:
+    __slots__ = ["seconds", "calls", "frames", "bytes"]
+
+    def __init__(self, seconds=0.0, calls=0, frames=0, bytes=0):
+        self.seconds = seconds
+        self.calls = calls
+        self.frames = frames
+        self.bytes = bytes
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _windows(array):
+    # Batched arrays have a leading frame axis, single windows don't.
+    return len(array) if array.ndim == 3 else 1
+
+
+def _measure_input(args, result):
+    return _windows(args[0]), args[0].nbytes
+
+
+def _measure_output(args, result):
+    return _windows(result), result.nbytes
+
+
+def _measure_frames(args, result):
+    return len(args[0]), args[0].nbytes
+
+
+def _measure_window(args, result):
+    return 1, 0
+
+
+def _measure_bytes(args, result):
+    return 0, len(result)
+
+
+class Profiler:
+    """
+    Accumulates the time spent, the number of calls and the time
+        windows and bytes processed by each stage of a conversion.
+
+    Stages are measured by wrapping the methods of a Converter and its
+        MidiWriter on the instances, so conversions without a profiler
+        run the plain methods. The time of a stage excludes the stages
+        called from it, apart from the total. With jobs > 1 the analysis
+        stages run in the worker processes and are only part of the
+        total.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        # The time spent in the stages called from the current one.
+        self.nested = 0.0
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage()
+        return self.stages[name]
+
+    def _call(self, stage, function, args, kwargs, inclusive=False):
+        outer, self.nested = self.nested, 0.0
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            stage.seconds += elapsed if inclusive else elapsed - self.nested
+            self.nested = outer + elapsed
+
+    def wrap(self, instance, method, name, measure=None, inclusive=False):
+        """
+        Replaces method on instance with a wrapper which records every
+            call under the stage name. measure is called with the
+            arguments and the result and returns the frames and bytes
+            processed.
+        """
+
+        function = getattr(instance, method)
+        stage = self.stage(name)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            result = self._call(stage, function, args, kwargs, inclusive)
+            stage.calls += 1
+            if measure:
+                frames, bytes = measure(args, result)
+                stage.frames += frames
+                stage.bytes += bytes
+            return result
+
+        setattr(instance, method, wrapper)
+
+    def wrap_generator(self, instance, method, name, measure=None):
+        """
+        Like wrap(), for generator methods. The time spent producing
+            each item is recorded as a call, and measure is called with
+            the item.
+        """
+
+        function = getattr(instance, method)
+        stage = self.stage(name)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            items = function(*args, **kwargs)
+            while True:
+                item = self._call(stage, next, (items, None), {})
+                if item is None:
+                    return
+                stage.calls += 1
+                if measure:
+                    frames, bytes = measure(item)
+                    stage.frames += frames
+                    stage.bytes += bytes
+                yield item
+
+        setattr(instance, method, wrapper)
+
+    def instrument_converter(self, converter):
+        self.wrap_generator(
+            converter, "_read_frames", "decode", lambda item: (len(item), item.nbytes)
+        )
+        self.wrap_generator(
+            converter, "_read_blocks", "decode", lambda item: (1, item.nbytes)
+        )
+        self.wrap(converter, "_distinct_channels", "dedupe", _measure_input)
+        self.wrap(converter, "_gate", "gate", _measure_input)
+        self.wrap(converter, "_frames_to_amplitudes", "fft", _measure_input)
+        self.wrap(converter, "_frames_to_spectrum", "fft", _measure_input)
+        self.wrap(converter, "_amplitudes_to_velocities", "reduce")
+        self.wrap(converter, "_reduce_velocities", "reduce", _measure_output)
+        self.wrap(converter, "_select_notes", "select", _measure_frames)
+        self.wrap(converter, "_freqs_to_midi", "select")
+        self.wrap(converter, "_velocities_to_notes", "select")
+        self.wrap(converter, "_save_checkpoint", "checkpoint")
+        self.wrap(converter, "convert", "total", inclusive=True)
+
+    def instrument_writer(self, writer):
+        self.wrap(writer, "add_notes", "write", _measure_window)
+        if hasattr(writer, "add_frames"):
+            self.wrap(writer, "add_frames", "write", _measure_frames)
+        if hasattr(writer, "to_bytes"):
+            self.wrap(writer, "to_bytes", "serialize", _measure_bytes)
+
+    def _ordered(self):
+        names = [name for name in STAGES if name in self.stages]
+        names += sorted(name for name in self.stages if name not in STAGES)
+        return [(name, self.stages[name]) for name in names if self.stages[name].calls]
+
+    def to_table(self):
+        total = self.stages.get("total")
+        total = total.seconds if total and total.seconds else None
+
+        lines = [
+            "{:<10} {:>8} {:>10} {:>7} {:>10} {:>12} {:>12}".format(
+                "stage", "calls", "seconds", "share", "frames", "bytes", "frames/s"
+            )
+        ]
+        for name, stage in self._ordered():
+            share = "{:.1%}".format(stage.seconds / total) if total else "-"
+            rate = stage.frames / stage.seconds if stage.seconds else 0.0
+            lines.append(
+                "{:<10} {:>8} {:>10.4f} {:>7} {:>10} {:>12} {:>12.1f}".format(
+                    name,
+                    stage.calls,
+                    stage.seconds,
+                    share,
+                    stage.frames,
+                    stage.bytes,
+                    rate,
+                )
+            )
+        return "\n".join(lines)
+
+    def to_json(self):
+        return json.dumps(
+            {"stages": {name: stage.as_dict() for name, stage in self._ordered()}},
+            indent=2,
+        )
+
+    def to_prometheus(self):
+        metrics = [
+            ("seconds", "Time spent in each conversion stage."),
+            ("calls", "Calls made to each conversion stage."),
+            ("frames", "Time windows processed by each conversion stage."),
+            ("bytes", "Bytes processed by each conversion stage."),
+        ]
+        lines = []
+        for field, help in metrics:
+            metric = "audio_to_midi_stage_{}_total".format(field)
+            lines.append("# HELP {} {}".format(metric, help))
+            lines.append("# TYPE {} counter".format(metric))
+            for name, stage in self._ordered():
+                lines.append(
+                    '{}{{stage="{}"}} {}'.format(metric, name, getattr(stage, field))
+                )
+        return "\n".join(lines)
+
+    def report(self, format="table"):
+        if format not in FORMATS:
+            raise RuntimeError("Invalid profile format: {}".format(format))
+        return getattr(self, "to_" + format)()
@@ -1,15 +1,45 @@
-import time
-import threading
-import progressbar
-
-
-class ProgressBar:
-    def __init__(self, current=0, total=0):
-        self.current = current
-        self.total = total
-        self.bar = progressbar.ProgressBar(max_value=self.total)
-
-    def update(self, current=0, total=0):
-        current = min(current, total)
-        self.bar.max_value = total
-        self.bar.update(current)
+import time
+import threading
+import progressbar
+
+
+class Throughput(progressbar.widgets.WidgetBase):
+    """
+    Shows the live rate of progress, converting the bar's units with
+        scale, e.g. time windows into seconds of audio.
+    """
+
+    def __init__(self, scale=1.0, unit="it", **kwargs):
+        super().__init__(**kwargs)
+        self.scale = scale
+        self.unit = unit
+
+    def __call__(self, progress, data):
+        elapsed = data["total_seconds_elapsed"]
+        if not elapsed or not data["value"]:
+            return "-- {}/s".format(self.unit)
+        return "{:.1f} {}/s".format(data["value"] * self.scale / elapsed, self.unit)
+
+
+class ProgressBar:
+    def __init__(self, current=0, total=0, scale=None, unit="it"):
+        self.current = current
+        self.total = total
+
+        widgets = None
+        if scale:
+            widgets = [
+                progressbar.Percentage(),
+                " ",
+                progressbar.Bar(),
+                " ",
+                Throughput(scale, unit),
+                " ",
+                progressbar.ETA(),
+            ]
+        self.bar = progressbar.ProgressBar(max_value=self.total, widgets=widgets)
+
+    def update(self, current=0, total=0):
+        current = min(current, total)
+        self.bar.max_value = total
+        self.bar.update(current)
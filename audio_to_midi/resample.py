@@ -0,0 +1,178 @@
+from functools import lru_cache
+
+import numpy
+
+# The number of filter taps on each side of the centre per unit of the
+# decimation factor, and the Kaiser window shape. At analysis rates of
+# 44.1 kHz or more the passband is flat to 0.05% beyond the highest midi
+# pitch, and the frequencies which alias below it are attenuated by 60 dB,
+# 20 dB below a velocity step. Aliases above the highest pitch are never
+# analysed, so the cutoff can be at the Nyquist frequency.
+TAPS_PER_FACTOR = 5
+KAISER_BETA = 6.0
+
+# The input frames filtered at once, which keeps them and their outputs
+# in the cache.
+CHUNK_FRAMES = 1 << 14
+
+# The least number of outputs computed by each row of the polyphase
+# matrices. Smaller matrix products are slower per output.
+ROW_OUTPUTS = 16
+
+# The number of filters kept for the decimation factors in use.
+FILTER_CACHE_SIZE = 8
+
+
+def decimation_factor(samplerate, analysis_rate=None):
+    """
+    Returns the largest integer factor which reduces samplerate to no
+        less than analysis_rate, or 1 when there's nothing to reduce.
+    """
+
+    if not analysis_rate or samplerate <= analysis_rate:
+        return 1
+    return int(samplerate // analysis_rate)
+
+
+@lru_cache(FILTER_CACHE_SIZE)
+def lowpass(factor):
+    """
+    Returns the taps of a Kaiser windowed sinc low pass filter with its
+        cutoff at the Nyquist frequency after decimating by factor, as a
+        read only array of odd length with unit DC gain.
+    """
+
+    half = TAPS_PER_FACTOR * factor
+    cutoff = 1 / (2 * factor)
+    positions = numpy.arange(-half, half + 1)
+
+    taps = 2 * cutoff * numpy.sinc(2 * cutoff * positions)
+    taps *= numpy.kaiser(len(taps), KAISER_BETA)
+    taps /= taps.sum()
+    taps.setflags(write=False)
+    return taps
+
+
+@lru_cache(FILTER_CACHE_SIZE)
+def polyphase(factor, dtype=numpy.float64):
+    """
+    Returns the filter of lowpass(factor) as two matrices of shape
+        (outputs * factor, outputs), each column holding the taps of one
+        output sample. Multiplying a row of outputs * factor inputs by
+        the first and the row which follows it by the second and adding
+        the products gives outputs consecutive decimated samples.
+    """
+
+    taps = lowpass(factor)
+    # A filter window spans at most two rows.
+    outputs = max(ROW_OUTPUTS, -(-(len(taps) - factor) // factor))
+    size = outputs * factor
+
+    matrix = numpy.zeros((2 * size, outputs), dtype=dtype)
+    for output in range(outputs):
+        matrix[output * factor : output * factor + len(taps), output] = taps
+
+    halves = numpy.ascontiguousarray(matrix[:size]), numpy.ascontiguousarray(
+        matrix[size:]
+    )
+    for half in halves:
+        half.setflags(write=False)
+    return halves
+
+
+class Decimator:
+    """
+    Low pass filters and decimates samples which arrive in blocks of any
+        size, carrying the filter's history across block boundaries.
+
+    Output sample n is centred on input sample n * factor, so the
+        filter adds no delay. The inputs before the first one are taken
+        from history, or are zeros.
+
+    Each channel is filtered in polyphase form as two matrix products
+        over rows of its inputs, so only the decimated outputs are
+        computed and the inputs are never copied into overlapping
+        windows.
+    """
+
+    def __init__(self, factor, channels, history=None, dtype=numpy.float64):
+        self.factor = factor
+        self.taps = lowpass(factor)
+        self.first, self.second = polyphase(factor, numpy.dtype(dtype))
+        self.delay = len(self.taps) // 2
+        self.dtype = dtype
+        self.inputs = 0
+        self.outputs = 0
+
+        self.pending = numpy.zeros((self.delay, channels))
+        if history is not None:
+            self.pending[self.delay - len(history) :] = history
+
+    def process(self, samples):
+        """
+        samples is an array of shape (frames, channels).
+
+        Returns every output sample whose filter window is complete.
+        """
+
+        total = len(self.pending) + len(samples)
+        count = 0
+        if total >= len(self.taps):
+            count = (total - len(self.taps)) // self.factor + 1
+
+        # Filtered by channel, so the outputs are returned transposed.
+        outputs = numpy.empty((self.pending.shape[1], count), dtype=self.dtype)
+        filled = 0
+        for start in range(0, max(len(samples), 1), CHUNK_FRAMES):
+            result = self._filter(samples[start : start + CHUNK_FRAMES])
+            outputs[:, filled : filled + result.shape[1]] = result
+            filled += result.shape[1]
+
+        return outputs.T
+
+    def _filter(self, samples):
+        self.inputs += len(samples)
+        total = len(self.pending) + len(samples)
+        channels = self.pending.shape[1]
+
+        count = 0
+        if total >= len(self.taps):
+            count = (total - len(self.taps)) // self.factor + 1
+
+        # The inputs of each channel are laid out in rows of size samples,
+        # padded with zeros to at least one row more than the outputs need.
+        size, outputs = self.first.shape
+        rows = -(-count // outputs)
+        length = max(rows + 1, -(-total // size)) * size
+        inputs = numpy.empty((channels, length), dtype=self.dtype)
+        inputs[:, : len(self.pending)] = self.pending.T
+        inputs[:, len(self.pending) : total] = samples.T
+        inputs[:, total:] = 0
+
+        blocks = inputs.reshape(channels, -1, size)
+        result = numpy.matmul(blocks[:, :rows], self.first)
+        result += numpy.matmul(blocks[:, 1 : rows + 1], self.second)
+
+        self.pending = inputs[:, count * self.factor : total].T.copy()
+        self.outputs += count
+
+        return result.reshape(channels, -1)[:, :count]
+
+    def flush(self, count=None):
+        """
+        Returns count more output samples, by default the rest of the
+            ones centred on the inputs processed so far, with zeros
+            after the last input.
+        """
+
+        if count is None:
+            count = -(-self.inputs // self.factor) - self.outputs
+        if count <= 0:
+            return numpy.zeros((0, self.pending.shape[1]))
+
+        padding = numpy.zeros((count * self.factor + self.delay, self.pending.shape[1]))
+        inputs = self.inputs
+        outputs = self.process(padding)[:count]
+        self.inputs = inputs
+
+        return outputs
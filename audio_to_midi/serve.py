@@ -0,0 +1,516 @@
+import io
+import itertools
+import json
+import logging
+import os
+import signal
+import socketserver
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import RawArray
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# The number of finished jobs whose status and result are kept.
+DEFAULT_HISTORY = 1000
+
+# The number of recent jobs the latency statistics cover.
+LATENCY_WINDOW = 1000
+
+# Cancellation flags shared with the worker processes, one per job id
+# modulo their number, which bounds the queue size.
+CANCEL_SLOTS = 1 << 12
+
+
+class JobCancelled(RuntimeError):
+    pass
+
+
+_cancel_flags = None
+
+
+def _init_worker(flags):
+    global _cancel_flags
+    _cancel_flags = flags
+
+    # Workers live as long as the daemon, so the analysis modules are
+    # imported and the pitch table is built once rather than per job.
+    # numpy keeps the fft plans of each worker warm in the same way.
+    from audio_to_midi import api, notes  # noqa: F401
+
+    notes.table()
+
+
+class _CancelCheck:
+    """
+    Passed to the Converter as its progress, which it updates after
+        every batch. Raises JobCancelled once the job's flag is set.
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def update(self, current=0, total=0):
+        if _cancel_flags[self.slot]:
+            raise JobCancelled("Job cancelled.")
+
+
+def _run_job(slot, source, outfile, options):
+    """
+    source is a path or the bytes of a sound file.
+
+    Converts source in a worker process. Returns the times the job
+        started and finished, and the MIDI file as bytes unless it was
+        written to outfile.
+    """
+
+    from audio_to_midi import api
+
+    started = time.time()
+    check = _CancelCheck(slot)
+    check.update()
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    data = api.convert_to_bytes(source, progress=check, **options)
+    if outfile:
+        with open(outfile, "wb") as stream:
+            stream.write(data)
+        data = None
+
+    return started, time.time(), data
+
+
+class Job:
+    __slots__ = [
+        "id",
+        "state",
+        "outfile",
+        "submitted",
+        "started",
+        "finished",
+        "result",
+        "error",
+        "future",
+        "done",
+    ]
+
+    def __init__(self, id, outfile=None):
+        self.id = id
+        self.state = "queued"
+        self.outfile = outfile
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.future = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        state = self.state
+        if state == "queued" and self.future and self.future.running():
+            state = "running"
+        return {
+            "id": self.id,
+            "state": state,
+            "outfile": self.outfile,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "bytes": len(self.result) if self.result is not None else None,
+            "error": self.error,
+        }
+
+
+def _summary(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+class JobQueue:
+    """
+    Runs conversion jobs on a pool of workers worker processes. At most
+        queue_size jobs are queued or running at once, and submit()
+        rejects jobs beyond that so clients back off.
+
+    Queued jobs are cancelled before they start, running jobs after the
+        batch they're converting.
+    """
+
+    def __init__(self, workers, queue_size, history=DEFAULT_HISTORY):
+        if not 0 < queue_size <= CANCEL_SLOTS:
+            raise RuntimeError("Invalid queue size: {}".format(queue_size))
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.history = history
+        self.flags = RawArray("b", CANCEL_SLOTS)
+        self.executor = self._create_executor()
+
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = OrderedDict()
+        self.pending = 0
+        self.counts = {"done": 0, "failed": 0, "cancelled": 0, "rejected": 0}
+        # The queue wait, conversion and total time of recent jobs.
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker, initargs=(self.flags,)
+        )
+
+    def submit(self, source, options, outfile=None):
+        """
+        source is a path or the bytes of a sound file.
+        options are the keyword arguments passed to the Converter.
+
+        Returns the queued Job, or None when the queue is full. Raises a
+            RuntimeError when a worker process died, after replacing
+            the pool so the next jobs can run.
+        """
+
+        with self.lock:
+            if self.pending >= self.queue_size:
+                self.counts["rejected"] += 1
+                return None
+            job = Job(next(self.ids), outfile)
+            self.flags[job.id % CANCEL_SLOTS] = 0
+            try:
+                job.future = self.executor.submit(
+                    _run_job, job.id % CANCEL_SLOTS, source, outfile, options
+                )
+            except BrokenProcessPool:
+                # The jobs which were running on the pool fail with the
+                # same error.
+                self.executor.shutdown(wait=False)
+                self.executor = self._create_executor()
+                logging.info("a worker process died, restarted the pool")
+                raise RuntimeError("A worker process died.")
+            self.jobs[job.id] = job
+            self.pending += 1
+            self._trim()
+
+        job.future.add_done_callback(lambda future: self._finish(job))
+        return job
+
+    def _trim(self):
+        while len(self.jobs) > self.history + self.pending:
+            oldest = next(
+                (job for job in self.jobs.values() if job.finished is not None), None
+            )
+            if oldest is None:
+                return
+            del self.jobs[oldest.id]
+
+    def _finish(self, job):
+        future = job.future
+        error = None if future.cancelled() else future.exception()
+
+        with self.lock:
+            self.pending -= 1
+            job.finished = time.time()
+            if future.cancelled() or isinstance(error, JobCancelled):
+                job.state = "cancelled"
+            elif error:
+                job.state = "failed"
+                job.error = "{}: {}".format(type(error).__name__, error)
+            else:
+                job.started, finished, job.result = future.result()
+                job.state = "done"
+                self.latencies.append(
+                    (
+                        job.started - job.submitted,
+                        finished - job.started,
+                        job.finished - job.submitted,
+                    )
+                )
+            self.counts[job.state] += 1
+        job.done.set()
+
+        logging.info("job {}: {}".format(job.id, job.state))
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(id)
+
+    def cancel(self, id):
+        """
+        Cancels the job id, and returns it or None when it's unknown.
+        """
+
+        job = self.get(id)
+        if job and job.future is None:
+            return job
+        if job and not job.future.cancel() and not job.future.done():
+            self.flags[id % CANCEL_SLOTS] = 1
+        return job
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "pending": self.pending,
+                "running": min(self.pending, self.workers),
+                "queued": max(0, self.pending - self.workers),
+            }
+            stats.update(self.counts)
+
+        stats["latency"] = {
+            name: _summary([latency[index] for latency in latencies])
+            for index, name in enumerate(["wait", "run", "total"])
+        }
+        return stats
+
+    def shutdown(self):
+        for id, job in list(self.jobs.items()):
+            if job.future is not None and not job.future.done():
+                self.cancel(id)
+        self.executor.shutdown()
+
+
+def _inside(path, root):
+    path = os.path.realpath(path)
+    root = os.path.realpath(root)
+    return os.path.commonpath([path, root]) == root
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    The HTTP interface of the daemon:
+
+    POST /jobs queues a job. A JSON body gives the "path" of the input,
+        the command line "args", an optional "output" path and "wait".
+        Any other body is the sound file itself, with the args, output
+        and wait in the query string as repeated arg=, output= and
+        wait=1.
+    GET /jobs/<id> returns the job's status, and GET /jobs/<id>/result
+        its MIDI file once it's done.
+    DELETE /jobs/<id> cancels the job.
+    GET /stats returns the queue depth, job counts and latencies.
+
+    The paths a job reads and writes, its input, output and --cache-dir,
+        must be inside the server's root directory. Without one they're
+        only accepted over a Unix socket, whose permissions decide who
+        can connect.
+    """
+
+    server_version = "audio-to-midi"
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send(self, status, body, content_type="application/json", headers=()):
+        if content_type == "application/json":
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job(self, parts):
+        try:
+            job = self.server.jobs.get(int(parts[1]))
+        except ValueError:
+            job = None
+        if not job:
+            self._send(404, {"error": "Unknown job."})
+        return job
+
+    def _send_result(self, job):
+        if job.state == "done":
+            if job.result is None:
+                self._send(200, job.as_dict())
+            else:
+                self._send(200, job.result, "audio/midi")
+        elif job.state == "failed":
+            self._send(500, job.as_dict())
+        elif job.state == "cancelled":
+            self._send(410, job.as_dict())
+        else:
+            self._send(409, job.as_dict())
+
+    def _check_paths(self, paths):
+        """
+        Raises a RuntimeError if any of paths isn't allowed.
+        """
+
+        for path in paths:
+            if self.server.root:
+                if not _inside(path, self.server.root):
+                    raise RuntimeError(
+                        "{} is outside {}".format(path, self.server.root)
+                    )
+            elif not isinstance(self.server, _UnixHTTPServer):
+                raise RuntimeError(
+                    "Paths are only accepted over a Unix socket or with --root"
+                )
+
+    def _parts(self):
+        return [part for part in urlparse(self.path).path.split("/") if part]
+
+    def do_GET(self):
+        parts = self._parts()
+        if parts == ["stats"]:
+            self._send(200, self.server.jobs.stats())
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self._job(parts)
+            if not job:
+                return
+            if len(parts) == 2:
+                self._send(200, job.as_dict())
+            elif parts[2] == "result":
+                self._send_result(job)
+            else:
+                self._send(404, {"error": "Not found."})
+        else:
+            self._send(404, {"error": "Not found."})
+
+    def do_DELETE(self):
+        parts = self._parts()
+        if len(parts) != 2 or parts[0] != "jobs":
+            self._send(404, {"error": "Not found."})
+            return
+        try:
+            job = self.server.jobs.cancel(int(parts[1]))
+        except ValueError:
+            job = None
+        if job:
+            self._send(202, job.as_dict())
+        else:
+            self._send(404, {"error": "Unknown job."})
+
+    def do_POST(self):
+        if self._parts() != ["jobs"]:
+            self._send(404, {"error": "Not found."})
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                spec = json.loads(body.decode())
+                if not spec.get("path"):
+                    raise RuntimeError("A job needs a path or a sound file.")
+                source = name = spec["path"]
+                paths = [source]
+            else:
+                query = parse_qs(urlparse(self.path).query)
+                spec = {
+                    "args": query.get("arg", []),
+                    "output": query.get("output", [None])[0],
+                    "wait": query.get("wait", [""])[0] not in ("", "0"),
+                }
+                source = body
+                name = "upload"
+                paths = []
+            options = self.server.parse_options(name, list(spec.get("args", [])))
+        except (RuntimeError, SystemExit, ValueError) as e:
+            self._send(400, {"error": "Invalid job: {}".format(e)})
+            return
+
+        if spec.get("output"):
+            paths.append(spec["output"])
+        if options.get("cache"):
+            paths.append(options["cache"].directory)
+        try:
+            self._check_paths(paths)
+        except RuntimeError as e:
+            self._send(403, {"error": "Forbidden job: {}".format(e)})
+            return
+
+        try:
+            job = self.server.jobs.submit(source, options, spec.get("output"))
+        except RuntimeError as e:
+            self._send(503, {"error": str(e)}, headers=[("Retry-After", "1")])
+            return
+        if not job:
+            self._send(503, {"error": "Queue full."}, headers=[("Retry-After", "1")])
+            return
+
+        logging.info("job {}: queued {}".format(job.id, name))
+        if spec.get("wait"):
+            job.done.wait()
+            self._send_result(job)
+        else:
+            self._send(202, job.as_dict())
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(
+    parse_options,
+    socket=None,
+    host=DEFAULT_HOST,
+    port=DEFAULT_PORT,
+    workers=None,
+    queue_size=None,
+    history=DEFAULT_HISTORY,
+    root=None,
+):
+    """
+    parse_options is called with an input name and a list of command
+        line arguments and returns the Converter options, raising a
+        RuntimeError when they're invalid.
+    root is the directory which the paths of jobs must be inside.
+
+    Serves conversion jobs over HTTP on the Unix socket path socket, or
+        on host and port, until interrupted.
+    """
+
+    workers = workers or os.cpu_count() or 1
+    jobs = JobQueue(workers, queue_size or 4 * workers, history)
+
+    if socket:
+        if os.path.exists(socket):
+            os.remove(socket)
+        server = _UnixHTTPServer(socket, Handler)
+        address = socket
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+        address = "http://{}:{}".format(*server.server_address[:2])
+    server.jobs = jobs
+    server.parse_options = parse_options
+    server.root = root
+
+    logging.info(
+        "serving on {} with {} workers, queue size {}".format(
+            address, jobs.workers, jobs.queue_size
+        )
+    )
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    # Service managers stop the daemon with SIGTERM, which shuts it down
+    # like an interrupt does.
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        jobs.shutdown()
+        if socket and os.path.exists(socket):
+            os.remove(socket)
@@ -0,0 +1,267 @@
+import time
+
+from collections import namedtuple
+
+import numpy
+import soundfile
+
+import python3_midi as midi
+
+from audio_to_midi import converter, midi_writer, resample
+
+# A note event with an absolute tick. type is the MIDI status nibble,
+# 0x90 for note on and 0x80 for note off.
+Event = namedtuple("Event", ["tick", "type", "channel", "pitch", "velocity"])
+
+
+class CallbackStream:
+    """
+    Stands in for python3_midi's FileStream, handing every note event
+        to a callback as soon as the MidiWriter adds it.
+
+    Events which have already been handed out can't be changed, so
+        condensed notes keep the velocity they started with.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.tick = 0
+        self.count = 0
+        self.active = {}
+        self.positions = {}
+
+    def start_pattern(self, **kwargs):
+        pass
+
+    def start_track(self, **kwargs):
+        pass
+
+    def add_event(self, event):
+        pos = self.count
+        self.count += 1
+        self.tick += event.tick
+
+        if not isinstance(event, midi.NoteOnEvent):
+            return pos
+
+        # MidiWriter writes note offs as zero velocity note ons. Only the
+        # events of sounding notes are kept, for condensed velocity lookups.
+        pitch, velocity = event.data
+        if velocity:
+            self.positions[(event.channel, pitch)] = pos
+            self.active[pos] = event
+            type = midi_writer.NOTE_ON
+        else:
+            self.active.pop(self.positions.pop((event.channel, pitch), None), None)
+            type = midi_writer.NOTE_OFF
+
+        self.callback(Event(self.tick, type, event.channel, pitch, velocity))
+
+        return pos
+
+    def get_event(self, type, pos):
+        return self.active[pos]
+
+    def end_track(self):
+        pass
+
+    def end_pattern(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamConverter:
+    """
+    Converts audio which arrives incrementally. Every time window is
+        analysed as soon as its last sample arrives, and the resulting
+        note events are either written to a growing MIDI file, when the
+        converter has an outfile, or handed to callback.
+
+    Feeding the samples of a file gives the same notes as
+        Converter.convert() on that file.
+    """
+
+    def __init__(self, converter, callback=None):
+        self.converter = converter
+        self.callback = callback
+        self.block_size = converter.block_size
+        self.hop_size = converter.hop_size
+        # Samples arrive with the input channels, and are selected or
+        # mixed into the analysed channels before anything else.
+        self.input_channels = converter.info.channels
+        self.channels = converter.channels
+        self.decimator = None
+        if converter.decimation > 1:
+            self.decimator = resample.Decimator(
+                converter.decimation, self.channels, dtype=converter.dtype
+            )
+
+        self.events = []
+        self.buffer = numpy.zeros((self.block_size, self.channels))
+        self.filled = 0
+
+        self.windows = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        if converter.outfile:
+            stream = midi.FileStream(converter.outfile)
+        else:
+            stream = CallbackStream(self._emit)
+        self.writer = converter._create_writer(stream=stream)
+
+    def __enter__(self):
+        self.writer.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None and self.decimator:
+            self._append(self.decimator.flush())
+        if type is None and self.filled:
+            # Pad the windows which start in the remaining samples, as
+            # Converter.convert() does.
+            count = -(-self.filled // self.hop_size)
+            padded = numpy.zeros(
+                ((count - 1) * self.hop_size + self.block_size, self.channels)
+            )
+            padded[: self.filled] = self.buffer[: self.filled]
+            self._analyse(self._windows(padded, count))
+        self.writer.__exit__(type, value, traceback)
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.windows if self.windows else 0.0
+
+    def _emit(self, event):
+        self.events.append(event)
+        if self.callback:
+            self.callback(event)
+
+    def _analyse(self, frames):
+        start = time.perf_counter()
+
+        velocities = self.converter._frames_to_velocities(frames)
+        for notes in self.converter._velocities_to_notes(velocities):
+            self.writer.add_notes(notes)
+        self.writer.flush()
+
+        # Every window in the batch waited for the whole batch.
+        latency = time.perf_counter() - start
+        self.windows += len(frames)
+        self.total_latency += latency * len(frames)
+        self.max_latency = max(self.max_latency, latency)
+
+    def _windows(self, samples, count):
+        return numpy.lib.stride_tricks.sliding_window_view(
+            samples, self.block_size, axis=0
+        )[:: self.hop_size][:count].transpose(0, 2, 1)
+
+    def drain(self):
+        """
+        Returns the events emitted since the last call.
+        """
+
+        events, self.events = self.events, []
+        return events
+
+    def feed(self, samples):
+        """
+        samples is an array of shape (frames, channels), or (frames,)
+            for mono input.
+
+        Analyses every time window completed by samples in one batch
+            and returns the events emitted by them. Samples which are
+            shared by the following windows are held back.
+        """
+
+        samples = numpy.asarray(samples, dtype=float).reshape(-1, self.input_channels)
+        samples = self.converter._mix_channels(samples)
+        if self.decimator:
+            samples = self.decimator.process(samples)
+        self._append(samples)
+
+        return self.drain()
+
+    def _append(self, samples):
+        """
+        Analyses the windows completed by samples at the analysis rate.
+        """
+
+        if self.filled:
+            samples = numpy.concatenate([self.buffer[: self.filled], samples])
+
+        count = 0
+        if len(samples) >= self.block_size:
+            count = (len(samples) - self.block_size) // self.hop_size + 1
+            self._analyse(self._windows(samples, count))
+
+        # Keep the samples of the windows which haven't been completed yet.
+        remainder = samples[count * self.hop_size :]
+        self.buffer[: len(remainder)] = remainder
+        self.filled = len(remainder)
+
+
+def stream_events(converter, buffers):
+    """
+    buffers is an iterable of sample arrays accepted by
+        StreamConverter.feed().
+
+    A generator which yields the note events of each buffer as soon as
+        it has been analysed.
+    """
+
+    stream = StreamConverter(converter)
+    with stream:
+        for buffer in buffers:
+            yield from stream.feed(buffer)
+    yield from stream.drain()
+
+
+def convert_stream(
+    source,
+    outfile=None,
+    callback=None,
+    samplerate=None,
+    channels=None,
+    subtype="PCM_16",
+    **options
+):
+    """
+    source is a file descriptor or file-like object, which doesn't need
+        to be seekable, such as stdin.
+    options are the keyword arguments passed to the Converter.
+
+    Reads WAV data, or raw PCM data when samplerate and channels are
+        given, one time window at a time and converts each window as
+        soon as it has been read. Returns the StreamConverter so its
+        latency can be inspected.
+    """
+
+    if samplerate:
+        raw = {
+            "format": "RAW",
+            "samplerate": samplerate,
+            "channels": channels or 1,
+            "subtype": subtype,
+        }
+    else:
+        raw = {}
+
+    with soundfile.SoundFile(source, closefd=False, **raw) as infile:
+        process = converter.Converter(
+            outfile=outfile,
+            samplerate=infile.samplerate,
+            channels=infile.channels,
+            **options
+        )
+        stream = StreamConverter(process, callback)
+        with stream:
+            while True:
+                block = infile.read(process.block_size, always_2d=True)
+                if not len(block):
+                    break
+                stream.feed(block)
+
+    return stream
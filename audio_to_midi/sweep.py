@@ -0,0 +1,165 @@
+import itertools
+import logging
+import os
+
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from audio_to_midi import converter
+
+# The options which only change how notes are selected from the spectrum
+# and written, so configurations which differ in nothing else share the
+# decoding and the fft.
+SELECTION_OPTIONS = [
+    "activation_level",
+    "note_count",
+    "pitch_set",
+    "pitch_range",
+    "transpose",
+    "condense",
+    "condense_max",
+    "max_note_length",
+    "bpm",
+]
+
+# The short names of swept options in output file names.
+LABELS = OrderedDict(
+    [
+        ("time_window", "t"),
+        ("activation_level", "a"),
+        ("note_count", "C"),
+        ("pitch_set", "p"),
+        ("transpose", "T"),
+        ("condense", "c"),
+    ]
+)
+
+
+def grid(**values):
+    """
+    values maps option names to lists of values.
+
+    Returns a dict of options for every combination of the values, the
+        last option varying fastest.
+    """
+
+    names = list(values)
+    return [
+        dict(zip(names, combination))
+        for combination in itertools.product(*values.values())
+    ]
+
+
+def _label(value):
+    if isinstance(value, (list, tuple)):
+        return "-".join(str(item) for item in value) or "all"
+    if isinstance(value, float):
+        return "{:g}".format(value)
+    return str(value)
+
+
+def output_path(infile, config, output_dir=None):
+    """
+    config is a dict of the swept options of one configuration.
+
+    Returns the MIDI file path for the configuration, named after the
+        input and the value of each option, e.g. song.wav.a0.1_C3.mid,
+        either next to the input or inside output_dir.
+    """
+
+    labels = "_".join(
+        LABELS.get(name, name) + _label(value) for name, value in config.items()
+    )
+    name = "{}.{}.mid".format(os.path.basename(infile), labels or "sweep")
+    return os.path.join(output_dir or os.path.dirname(infile), name)
+
+
+def _convert_group(converters, progress=None):
+    """
+    Converts the input of converters, which only differ in their
+        SELECTION_OPTIONS, with each of them from a single pass over
+        the spectrum. Returns their writers.
+    """
+
+    # A window which the gate skips at the lowest activation level is
+    # silent at every level.
+    analysis = min(converters, key=lambda item: item.activation_level)
+    analysis.progress = progress
+    batch_size = analysis.batch_size or converter.DEFAULT_BATCH_SIZE
+
+    if analysis._cached():
+        spectrum = analysis._cached_spectrum()
+        batches = (
+            spectrum[start : start + batch_size]
+            for start in range(0, len(spectrum), batch_size)
+        )
+    else:
+        batches = map(analysis._gated_spectrum, analysis._read_frames())
+
+    # Configurations with the same activation level and pitch mapping
+    # share the reduced velocities, and those which also keep the same
+    # number of notes share the selection.
+    keys = [
+        (item.activation_level, item.bin_indices.tobytes(), item.bin_pitches.tobytes())
+        for item in converters
+    ]
+
+    with ExitStack() as stack:
+        writers = [stack.enter_context(item._create_writer()) for item in converters]
+        for spectrum in batches:
+            reduced = {}
+            selected = {}
+            for item, writer, key in zip(converters, writers, keys):
+                if key not in reduced:
+                    reduced[key] = item._spectrum_to_velocities(spectrum)
+                if (key, item.note_count) not in selected:
+                    selected[key, item.note_count] = item._select_notes(reduced[key])
+                item._write_velocities(writer, selected[key, item.note_count])
+
+    if analysis.gate and not analysis._cached():
+        logging.info(
+            "energy gate: skipped {} of {} windows".format(
+                analysis.skipped, analysis.windows
+            )
+        )
+    return writers
+
+
+def convert_sweep(infile, configs, progress=None, **options):
+    """
+    infile is the path of a sound file.
+    configs is a list of dicts of Converter options, each of which
+        overrides options for one configuration. Only the outfile, the
+        time_window and the SELECTION_OPTIONS can differ between them.
+    options are the Converter options shared by every configuration.
+
+    Converts infile with every configuration, decoding it and computing
+        its spectrum once per time window, and returns the writer of
+        each configuration.
+    """
+
+    groups = OrderedDict()
+    for index, config in enumerate(configs):
+        unknown = set(config) - set(SELECTION_OPTIONS) - {"outfile", "time_window"}
+        if unknown:
+            raise RuntimeError(
+                "Options which can't be swept: {}".format(", ".join(sorted(unknown)))
+            )
+        time_window = config.get("time_window", options.get("time_window"))
+        groups.setdefault(time_window, []).append(index)
+
+    writers = [None] * len(configs)
+    for time_window, indices in groups.items():
+        logging.info(
+            "sweep: {} configurations at a {} ms time window".format(
+                len(indices), time_window
+            )
+        )
+        converters = [
+            converter.Converter(infile=infile, **dict(options, **configs[index]))
+            for index in indices
+        ]
+        for index, writer in zip(indices, _convert_group(converters, progress)):
+            writers[index] = writer
+
+    return writers
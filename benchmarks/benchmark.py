@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+"""
+Benchmarks audio-to-midi on deterministic synthetic fixtures.
+
+    python3 benchmarks/benchmark.py run -o results.json
+    python3 benchmarks/benchmark.py compare baseline.json results.json
+    python3 benchmarks/benchmark.py startup --budget 0.1
+    python3 benchmarks/benchmark.py fft --tolerance 1
+    python3 benchmarks/benchmark.py events
+
+Each case runs in a fresh process so its peak RSS can be reported.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+import soundfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from audio_to_midi import converter, fft, midi_writer  # noqa: E402
+
+# name, signal, samplerate, channels, seconds
+CASES = [
+    ("chord-44k-mono", "chord", 44100, 1, 30),
+    ("chord-44k-stereo", "chord", 44100, 2, 30),
+    ("noise-44k-stereo", "noise", 44100, 2, 30),
+    ("chord-22k-mono", "chord", 22050, 1, 30),
+    ("chord-96k-stereo", "chord", 96000, 2, 30),
+    ("chord-48k-6ch", "chord", 48000, 6, 10),
+]
+
+# Converter options shared by every case, as the CLI would pass them.
+OPTIONS = {
+    "time_window": 5.0,
+    "activation_level": 0.0,
+    "condense": False,
+    "condense_max": False,
+    "max_note_length": 0,
+    "note_count": 0,
+    "transpose": 0,
+    "pitch_set": [],
+    "pitch_range": None,
+    "bpm": 60,
+    "batch_size": 512,
+}
+
+# The number of windows timed for the per window stages.
+STAGE_WINDOWS = 500
+
+# Runs the command line's --help, which has to stay fast.
+STARTUP_CODE = (
+    "import sys; sys.argv = ['audio-to-midi', '--help']; "
+    "from audio_to_midi.main import main; main()"
+)
+
+# The modules which --help must not import.
+HEAVY_MODULES = ["numpy", "soundfile", "python3_midi", "progressbar"]
+
+DEFAULT_STARTUP_BUDGET = 0.1
+
+# The FFT configurations compared with numpy in double precision, as the
+# backend, its workers and whether it analyses in single precision.
+FFT_CONFIGS = [
+    ("numpy", 1, False),
+    ("numpy", 1, True),
+    ("scipy", 1, False),
+    ("scipy", 1, True),
+    ("scipy", os.cpu_count() or 1, True),
+    ("pyfftw", 1, False),
+    ("pyfftw", 1, True),
+    ("pyfftw", os.cpu_count() or 1, True),
+]
+
+# The largest velocity difference allowed by default.
+DEFAULT_FFT_TOLERANCE = 1
+
+# The cases whose MIDI files are compared by the events command, with a
+# chord broken by silences which the energy gate skips.
+EVENT_CASES = CASES + [("bursts-44k-stereo", "bursts", 44100, 2, 30)]
+
+# The note selection and writer options the events command converts with.
+EVENT_CONFIGS = [
+    ("plain", {}),
+    ("condense", {"condense": True}),
+    ("condense-max", {"condense": True, "condense_max": True}),
+    ("max-length", {"condense": True, "max_note_length": 4}),
+    ("note-count", {"note_count": 2}),
+]
+
+# The ways of converting which must write the same MIDI file as a serial
+# conversion with MemoryMidiWriter.add_frames() and the energy gate.
+EVENT_VARIANTS = [
+    ("add_notes", {"in_memory": False}),
+    ("no-gate", {"gate": False}),
+    ("jobs", {"jobs": 2, "batch_size": 64}),
+]
+
+
+def generate(path, signal, samplerate, channels, seconds):
+    """
+    Writes a deterministic fixture: a C major chord which changes
+        every half second, the same chord silenced every other second,
+        or white noise, with each channel detuned or reseeded so no two
+        channels are identical.
+    """
+
+    rng = numpy.random.default_rng(0)
+    t = numpy.arange(int(samplerate * seconds)) / samplerate
+    data = numpy.zeros((len(t), channels))
+
+    for channel in range(channels):
+        if signal == "noise":
+            data[:, channel] = 0.3 * rng.standard_normal(len(t))
+            continue
+        shift = numpy.floor(t * 2) % 12 + channel
+        for amplitude, pitch in [(0.3, 60), (0.2, 64), (0.2, 67)]:
+            freq = 440 * 2 ** ((pitch + shift - 69) / 12)
+            data[:, channel] += amplitude * numpy.sin(2 * numpy.pi * freq * t)
+        if signal == "bursts":
+            data[numpy.floor(t) % 2 == 1, channel] = 0
+
+    soundfile.write(path, numpy.clip(data, -1, 1), samplerate, subtype="PCM_16")
+
+
+def _time(function, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def _stages(infile, channels):
+    """
+    Times each stage of the pipeline in isolation.
+    """
+
+    process = converter.Converter(infile=infile, outfile=os.devnull, **OPTIONS)
+    data, _ = soundfile.read(infile, always_2d=True)
+    windows = len(data) // process.block_size
+    frames = data[: windows * process.block_size].reshape(
+        windows, process.block_size, channels
+    )
+    sample = frames[:STAGE_WINDOWS]
+
+    freqs = [process._samples_to_freqs(block) for block in sample]
+    velocities = process._frames_to_velocities(frames)
+    notes = process._velocities_to_notes(velocities[:STAGE_WINDOWS])
+
+    def add_notes(cls):
+        with cls(os.devnull, channels, OPTIONS["time_window"]) as writer:
+            for frame in notes:
+                writer.add_notes(frame)
+
+    def add_frames():
+        with midi_writer.MemoryMidiWriter(
+            os.devnull, channels, OPTIONS["time_window"]
+        ) as writer:
+            writer.add_frames(velocities)
+
+    return {
+        "decode": _time(lambda: soundfile.read(infile, always_2d=True)),
+        "samples_to_freqs_per_window": _time(
+            lambda: [process._samples_to_freqs(block) for block in sample]
+        )
+        / len(sample),
+        "freqs_to_midi_per_window": _time(
+            lambda: [
+                process._freqs_to_midi(freq[:, channel])
+                for freq in freqs
+                for channel in range(channels)
+            ]
+        )
+        / len(sample),
+        "frames_to_velocities": _time(lambda: process._frames_to_velocities(frames)),
+        "add_notes_per_window": _time(lambda: add_notes(midi_writer.MidiWriter))
+        / len(notes),
+        "memory_add_notes_per_window": _time(
+            lambda: add_notes(midi_writer.MemoryMidiWriter)
+        )
+        / len(notes),
+        "add_frames": _time(add_frames),
+    }
+
+
+def _run_case(case, directory, queue):
+    name, signal, samplerate, channels, seconds = case
+    infile = os.path.join(directory, name + ".wav")
+    outfile = os.path.join(directory, name + ".mid")
+
+    elapsed = _time(
+        lambda: converter.Converter(infile=infile, outfile=outfile, **OPTIONS).convert()
+    )
+    result = {
+        "seconds": seconds,
+        "convert": elapsed,
+        "audio_seconds_per_second": seconds / elapsed,
+        # The peak of the conversion alone, ru_maxrss is in kilobytes.
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    result["stages"] = _stages(infile, channels)
+    queue.put((name, result))
+
+
+def run(output, names=None):
+    context = multiprocessing.get_context("spawn")
+    results = {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "cases": {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for case in CASES:
+            if names and case[0] not in names:
+                continue
+            # Fixtures are generated in their own process too, as a child
+            # inherits the peak RSS of its parent.
+            name, signal, samplerate, channels, seconds = case
+            infile = os.path.join(directory, name + ".wav")
+            process = context.Process(target=generate, args=(infile,) + case[1:])
+            process.start()
+            process.join()
+
+            queue = context.Queue()
+            process = context.Process(target=_run_case, args=(case, directory, queue))
+            process.start()
+            name, result = queue.get()
+            process.join()
+            results["cases"][name] = result
+            print(
+                "{:<20} {:8.3f} s {:10.1f} audio-s/s {:8d} KB".format(
+                    name,
+                    result["convert"],
+                    result["audio_seconds_per_second"],
+                    result["peak_rss_kb"],
+                )
+            )
+
+    with open(output, "w") as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+
+
+def _metrics(result):
+    """
+    Returns the timings and the peak RSS of a case by metric name.
+    """
+
+    metrics = {"convert": result["convert"]}
+    metrics.update(result.get("stages", {}))
+    metrics["peak_rss_kb"] = result["peak_rss_kb"]
+    return metrics
+
+
+def compare(baseline, current, threshold):
+    """
+    Flags every timing which is more than threshold slower than the
+        baseline, and every peak RSS more than threshold larger.
+        Metrics and cases are matched by name, and those found in only
+        one of the files are listed. Returns the number of regressions.
+    """
+
+    with open(baseline, "r") as infile:
+        baseline = json.load(infile)["cases"]
+    with open(current, "r") as infile:
+        current = json.load(infile)["cases"]
+
+    regressions = 0
+    for name in sorted(set(baseline) | set(current)):
+        if name not in current:
+            print("{:<20} only in the baseline".format(name))
+            continue
+        if name not in baseline:
+            print("{:<20} only in the current results".format(name))
+            continue
+
+        old = _metrics(baseline[name])
+        new = _metrics(current[name])
+        for metric in list(new) + [metric for metric in old if metric not in new]:
+            if metric not in new:
+                print("{:<20} {:<30} only in the baseline".format(name, metric))
+                continue
+            if metric not in old:
+                print("{:<20} {:<30} only in the current results".format(name, metric))
+                continue
+
+            before = old[metric]
+            after = new[metric]
+            ratio = after / before if before else 1.0
+            flag = ratio > 1 + threshold
+            regressions += flag
+            print(
+                "{:<20} {:<30} {:12.6f} {:12.6f} {:7.2f}x{}".format(
+                    name, metric, before, after, ratio, "  REGRESSION" if flag else ""
+                )
+            )
+
+    return regressions
+
+
+def _velocities(infile, backend, workers, float32):
+    """
+    Returns the selected velocities of every time window of infile and
+        the seconds spent analysing them.
+    """
+
+    process = converter.Converter(
+        infile=infile,
+        outfile=os.devnull,
+        fft_backend=backend,
+        fft_workers=workers,
+        float32=float32,
+        **OPTIONS
+    )
+    start = time.perf_counter()
+    velocities = numpy.concatenate(
+        [process._frames_to_velocities(frames) for frames in process._read_frames()]
+    )
+    return velocities, time.perf_counter() - start
+
+
+def compare_fft(tolerance, names=None):
+    """
+    Converts every case with each of the FFT_CONFIGS whose backend is
+        installed, and compares their velocities with numpy's in double
+        precision. Returns the number of configurations with a velocity
+        more than tolerance away from it.
+    """
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for case in CASES:
+            if names and case[0] not in names:
+                continue
+            infile = os.path.join(directory, case[0] + ".wav")
+            generate(infile, *case[1:])
+
+            baseline = None
+            for backend, workers, float32 in sorted(
+                set(FFT_CONFIGS), key=FFT_CONFIGS.index
+            ):
+                try:
+                    fft.Backend(backend, workers)
+                except RuntimeError:
+                    continue
+                velocities, seconds = _velocities(infile, backend, workers, float32)
+                if baseline is None:
+                    baseline = velocities
+
+                difference = numpy.abs(velocities.astype(int) - baseline)
+                flag = difference.max() > tolerance
+                failures += flag
+                print(
+                    "{:<20} {:<7} {:>2} {:<7} {:8.3f} s {:4d} max {:10.3e} differ{}".format(
+                        case[0],
+                        backend,
+                        workers,
+                        "float32" if float32 else "float64",
+                        seconds,
+                        int(difference.max()),
+                        numpy.count_nonzero(difference) / difference.size,
+                        "  OVER TOLERANCE" if flag else "",
+                    )
+                )
+
+    return failures
+
+
+def _midi(infile, outfile, options):
+    options = dict(OPTIONS, **options)
+    converter.Converter(infile=infile, outfile=outfile, **options).convert()
+    with open(outfile, "rb") as stream:
+        return stream.read()
+
+
+def compare_events(names=None):
+    """
+    Converts every case with each of the EVENT_CONFIGS, and compares
+        the MIDI file of each of the EVENT_VARIANTS with a serial
+        conversion using add_frames() and the energy gate. Returns the
+        number of files which differ.
+    """
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for case in EVENT_CASES:
+            if names and case[0] not in names:
+                continue
+            infile = os.path.join(directory, case[0] + ".wav")
+            outfile = os.path.join(directory, case[0] + ".mid")
+            generate(infile, *case[1:])
+
+            for config, options in EVENT_CONFIGS:
+                baseline = _midi(infile, outfile, options)
+                for variant, changes in EVENT_VARIANTS:
+                    data = _midi(infile, outfile, dict(options, **changes))
+                    flag = data != baseline
+                    failures += flag
+                    print(
+                        "{:<20} {:<14} {:<10} {:8d} bytes{}".format(
+                            case[0],
+                            config,
+                            variant,
+                            len(data),
+                            "  DIFFERS" if flag else "",
+                        )
+                    )
+
+    return failures
+
+
+def _import_times(code):
+    """
+    Runs code in a fresh interpreter with -X importtime and returns the
+        time spent importing in seconds and the names of the modules
+        which were imported.
+    """
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+    # Lines look like "import time:  self [us] | cumulative | name".
+    total = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, _, name = line[len("import time:") :].split("|")
+        total += int(own)
+        modules.add(name.strip())
+
+    return total / 1e6, modules
+
+
+def startup(budget, repeat=5):
+    """
+    Measures the import time of the command line's --help, keeping the
+        fastest of repeat runs. Returns the number of failures: the time
+        exceeding budget seconds, and every heavy module imported.
+    """
+
+    runs = [_import_times(STARTUP_CODE) for _ in range(repeat)]
+    seconds = min(run[0] for run in runs)
+    modules = runs[0][1]
+
+    failures = 0
+    over = seconds > budget
+    failures += over
+    print(
+        "{:<20} {:8.4f} s {:8.4f} s budget{}".format(
+            "startup", seconds, budget, "  OVER BUDGET" if over else ""
+        )
+    )
+    for name in HEAVY_MODULES:
+        if name in modules:
+            failures += 1
+            print("{:<20} imported by --help".format(name))
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument(
+        "--output", "-o", default="benchmark.json", help="The JSON file to write."
+    )
+    run_parser.add_argument(
+        "--case", nargs="+", help="Only run these cases.", choices=[c[0] for c in CASES]
+    )
+
+    compare_parser = commands.add_parser(
+        "compare", help="Compare results against a baseline."
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="The allowed slowdown as a fraction of the baseline. Default: 0.1",
+    )
+
+    startup_parser = commands.add_parser(
+        "startup", help="Check the import time of the command line."
+    )
+    startup_parser.add_argument(
+        "--budget",
+        type=float,
+        default=DEFAULT_STARTUP_BUDGET,
+        help="The allowed import time in seconds. Default: {}".format(
+            DEFAULT_STARTUP_BUDGET
+        ),
+    )
+    startup_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="The number of runs, of which the fastest counts. Default: 5",
+    )
+
+    fft_parser = commands.add_parser(
+        "fft", help="Compare the notes of the FFT backends and precisions."
+    )
+    fft_parser.add_argument(
+        "--tolerance",
+        type=int,
+        default=DEFAULT_FFT_TOLERANCE,
+        help="The allowed velocity difference. Default: {}".format(
+            DEFAULT_FFT_TOLERANCE
+        ),
+    )
+    fft_parser.add_argument(
+        "--case", nargs="+", help="Only run these cases.", choices=[c[0] for c in CASES]
+    )
+
+    events_parser = commands.add_parser(
+        "events",
+        help="Check that add_notes, the energy gate and parallel jobs write the same MIDI files.",
+    )
+    events_parser.add_argument(
+        "--case",
+        nargs="+",
+        help="Only run these cases.",
+        choices=[c[0] for c in EVENT_CASES],
+    )
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.output, args.case)
+    elif args.command == "fft":
+        if compare_fft(args.tolerance, args.case):
+            sys.exit(1)
+    elif args.command == "events":
+        if compare_events(args.case):
+            sys.exit(1)
+    elif args.command == "startup":
+        if startup(args.budget, args.repeat):
+            sys.exit(1)
+    elif compare(args.baseline, args.current, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,7 @@ setup(
     ],
     keywords="audio midi conversion",
     packages=["audio_to_midi"],
-    python_requires=">=3.5, <4",
+    python_requires=">=3.7, <4",
     entry_points={"console_scripts": ["audio-to-midi = audio_to_midi.main:main"]},
     install_requires=requirements,
 )